@@ -1,26 +1,45 @@
-from random import randint,random, choice
+from random import Random, randint
 from math import ceil, exp, log10
+from array import array
+from multiprocessing import Pool
+from copy import deepcopy
+import os
+import pickle
+import signal
+import threading
+
+from statsimusprime import draw_kernel, draw_solver
+
+# The legacy single character team labels, only used to read old text draws
+LEGACY_TEAM_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
 
 class Quiz:
     """Base class for a single quiz
 
-    The quiz expects up to three teams in the form of single utf-8 characters
-    which can be appended onto the quiz by the .push(...) function
+    The quiz expects up to three teams in the form of integer team ids, which
+    can be appended onto the quiz by the .push(...) function.
+
+    The team ids are stored in a `seats` array (three seats per quiz) with the
+    number of seated teams kept in a `counts` array. By default a quiz allocates
+    its own arrays, but `Prelims` passes in the arrays of the whole draw, so
+    that each `Quiz` is just a view onto quiz number `index` of the draw.
     """
-    def __init__(self,name,teams = ""):
+    def __init__(self,name,teams = (),seats = None,counts = None,index = 0):
         self.name = "{: >2}".format(name)
-        self.s = teams
-
-    @property
-    def s(self):
-        return self._s
-    @s.setter
-    def s(self,string):
-        ss = str(string)
-        if len(ss) > 3:
+        self._seats = array('h',[-1,-1,-1]) if seats is None else seats
+        self._counts = array('b',[0]) if counts is None else counts
+        self._index = index
+        if len(teams) > 3:
             # Ensure that there are only ever three teams / quiz
             raise ValueError("Quiz can only have 3 teams")
-        self._s = ss
+        for t in teams:
+            self.push(t)
+
+    @property
+    def teams(self):
+        # The team ids seated in the quiz
+        o = 3*self._index
+        return self._seats[o:o+self._counts[self._index]]
 
     @property
     def full(self):
@@ -32,22 +51,30 @@ class Quiz:
         return len(self) == 0
 
     def __repr__(self):
-        return "<"+self.s+(3-len(self.s))*"_"+">"
+        return "<"+",".join([str(t) for t in self.teams]+(3-len(self))*["_"])+">"
     def __str__(self):
         return self.__repr__()
 
     def __len__(self):
-        return len(self.s)
+        return self._counts[self._index]
 
-    def push(self,char):
-        # Append a team to the quiz (single utf-8 character)
-        self.s = self.s + char
+    def push(self,t):
+        # Append a team to the quiz (integer team id)
+        n = len(self)
+        if n == 3:
+            # Ensure that there are only ever three teams / quiz
+            raise ValueError("Quiz can only have 3 teams")
+        self._seats[3*self._index+n] = t
+        self._counts[self._index] = n+1
 
     def pop(self,index):
         # Pop a team out of the quiz based of the index of the team
+        o, n = 3*self._index, len(self)
         i = index%3
-        v = self.s[i]
-        self.s = self.s[:i]+self.s[i+1:]
+        v = self._seats[o+i]
+        self._seats[o+i:o+n-1] = self._seats[o+i+1:o+n]
+        self._seats[o+n-1] = -1
+        self._counts[self._index] = n-1
         return v
 
 class Prelims:
@@ -103,9 +130,11 @@ class Prelims:
     >>> R = 6 # number of rooms
     >>> breaklocation = 0.5 # location of the day break
     >>> d = Prelims(T,QpT,R,breaklocation)
-    >>> d.initialize() # Create an initial (bad) draw
-    >>> print("Annealing") # Randomize
+    >>> d.initialize() # Create an initial draw
+    >>> print("Annealing") # Randomize, then freeze
     >>> d.anneal(10**5, verbose=True)
+    >>> # Or, only refine the initial draw
+    >>> # d.initialize().anneal(10**4, kTmax = d.refine_kTmax, verbose=True)
     >>> stats = d.get_stats(verbose=True) # Print out statistics on the draw
     >>> print(d.to_text()) # Format into text
     """
@@ -116,19 +145,81 @@ class Prelims:
     already_seen = 0.1
     already_quizzed = 0.05
     currently_quizzing = 10.0
+    cross_division = 10.0
+    # Penalties for the optional terms, which are only switched on by an
+    #  energy spec (see .compile_energy(...))
+    preferred_room = 0.5
+    unavailable = 10.0
+    sibling_conflict = 5.0
+    early_slots = 1.0
+    late_slots = 1.0
+
+    # The names of the energy terms, in the order used by .get_team_events(...)
+    energy_terms = (
+        "currently_quizzing",
+        "already_quizzed",
+        "back_to_back",
+        "hat_trick",
+        "already_seen",
+        "cross_division",
+        "preferred_room",
+        "unavailable",
+        "sibling_conflict",
+        "early_slots",
+        "late_slots"
+    )
 
-    def __init__(self, nTeams, QpT, nRooms, breakloc = None, numblanks = None):
+    # How the Metropolis steps are run: "python" runs them one by one in Python,
+    #  "kernel" runs them in statsimusprime/draw_kernel.py (compiled if numba is
+    #  installed, otherwise it is slower than "python") and "auto" uses the
+    #  kernel only if it is compiled and the energy spec doesn't use any
+    #  optional terms. Note, the kernel uses its own
+    #  random number generator, so a seed gives a different draw for each, and
+    #  with "auto" whether numba is installed changes the draw. So the kernel
+    #  is opt-in, and a seed always gives the same draw by default
+    backend = "python"
+
+    # A starting temperature for .anneal(...), to refine the draw from
+    #  .initialize() rather than randomize it. Annealing from the default
+    #  kT = 5 throws away the initial draw (e.g. 90 teams: E = 8.8 -> 35)
+    refine_kTmax = 0.1
+
+    # Probability that a proposed interchange involves a "hot" team, one which
+    #  is quizzing in two places at once, has a hat trick or crosses divisions
+    hot_bias = 0.8
+
+    def __init__(self, nTeams, QpT, nRooms, breakloc = None, numblanks = None, seed = None, divisions = None, division_rooms = None, energy = None):
         """
         nTeams : The number of teams in the Meet
         QpT : The number of quizzes per team
         nRoom : The number of rooms
         brealoc : A float specifying the approximate location of the day break
         numblanks : The number of blank quizzes to include
+        seed : The seed for the random number generator of the draw, None
+            picks one at random. Two draws created with the same parameters and
+            seed, and optimized the same way, will be identical
+        divisions : A list of the (integer) division of each team, None puts
+            every team in division 0. Teams only quiz teams in their own division
+        division_rooms : A list, for each division, of the room indices that
+            division may use (rooms can be shared between divisions), or None
+            for any room. None lets every division use every room
+        energy : A dictionary energy spec, which sets the energy weights and
+            switches on the optional energy terms, see .compile_energy(...)
         """
 
         assert nTeams/3 >= nRooms, "Too many rooms!"
         assert QpT%3==0 or nTeams%3==0, "Either teams or qpT must be divisible by 3"
 
+        # The division of each team, and which rooms each division can use
+        self.divisions = [0]*nTeams if divisions is None else list(divisions)
+        assert len(self.divisions) == nTeams, "Every team needs a division"
+        nDivisions = max(self.divisions)+1
+        for d in range(nDivisions):
+            assert (QpT*self.divisions.count(d))%3 == 0, "Either teams or qpT must be divisible by 3 in each division"
+        division_rooms = division_rooms or nDivisions*[None]
+        self.room_ok = [[rooms is None or ri in rooms for ri in range(nRooms)] for rooms in division_rooms]
+        self.multidivision = nDivisions > 1 or not all(all(ok) for ok in self.room_ok)
+
         S = ceil(nTeams*QpT/3/nRooms)
         self.B = numblanks or S*nRooms-QpT*nTeams//3
         self.R = nRooms
@@ -139,22 +230,180 @@ class Prelims:
         bl = breakloc or 1.1
         self.breakindex = int(round(self.S*bl))
         self.qpt = QpT
+        self.seed = randint(0,2**31) if seed is None else seed
+        self.rng = Random(self.seed)
+
+        # The draw is stored as a flat slot x room x seat array of team ids
+        #  (-1 for an empty seat), along with the number of teams in each quiz.
+        #  `self.draw` holds `Quiz` views onto these arrays for rendering
+        self.seats = array('h',[-1])*(3*self.S*self.R)
+        self.counts = array('b',[0])*(self.S*self.R)
         self.draw = []
         i = 0
         for s in range(self.S):
             self.draw.append([])
             for _ in range(min(self.Q+self.B-i,self.R)):
-                self.draw[-1].append(Quiz(str(i+1)))
+                self.draw[-1].append(Quiz(str(i+1),seats=self.seats,counts=self.counts,index=i))
                 i += 1
-        self.Tlist = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"[:self.T]
-        self.Tquiz = {t:[] for t in self.Tlist}
+        # The (slot, room) positions of each team, indexed by team id (teams
+        #  are numbered 0 to nTeams-1)
+        self.Tquiz = [[] for _ in range(self.T)]
+        # The number of times each pair of teams meet, stored sparsely as a
+        #  dictionary for each team id (`self.pairs[t][other]`), and kept up to
+        #  date by .push(...) and .pop(...)
+        self.pairs = [{} for _ in range(self.T)]
+        # The number of quizzes each team has in each slot, as a flat slot x
+        #  team array, kept up to date by .push(...) and .pop(...)
+        self.occupancy = array('b',[0])*(self.S*self.T)
+        # The "hot" team indices (see ._update_hot(...)) and their positions in
+        #  `self.hot`, built lazily and reset by .push(...) and .pop(...)
+        self.hot = None
+        self._hot_index = {}
+        # The state of the current .anneal(...) or .thermalize(...) run, which
+        #  is saved with checkpoints (see ._metropolis(...))
+        self._run = None
+
+        # The compiled optional energy terms, None while a term is off
+        self.room_cost = None
+        self.slot_cost = None
+        self.siblings = None
+        # The sibling group of each team id, the number of quizzes each group
+        #  has in each slot (a flat slot x group array) and the sibling
+        #  conflicts of each team id, kept up to date by .push(...) and
+        #  .pop(...) while the siblings term is on
+        self.sibling_group = None
+        self.nGroups = 0
+        self.group_occupancy = None
+        self.sibling_events = None
+        self.early_cap = None
+        self.late_cap = None
+        self.optional_terms = False
+        if energy is not None:
+            self.compile_energy(energy)
 
     def __repr__(self):
         l = [", ".join([q.name+str(q) for q in s]) for s in self.draw]
         l.insert(self.breakindex,"")
         return "\n".join(l)
 
-    def _generate_open(self,char):
+    def compile_energy(self, spec):
+        """Set up the energy function from a declarative energy spec
+
+        Every term is optional, and teams, rooms and slots are all 0 indexed:
+            {
+                "weights": {"back_to_back": 0.5, ...},
+                "preferred_rooms": {"weight": 0.5, "teams": {0: [1, 2], ...}},
+                "unavailable": {"weight": 10.0, "teams": {3: [0, 1], ...}},
+                "siblings": {"weight": 5.0, "groups": [[4, 5], ...]},
+                "early_slots": {"weight": 1.0, "slots": 2, "max": 1},
+                "late_slots": {"weight": 1.0, "slots": 2, "max": 1}
+            }
+        "weights" overrides the penalties of any of the `.energy_terms`. The
+        other items switch on the optional terms, each of which counts:
+            preferred_rooms : quizzes a team has outside of its listed rooms
+            unavailable : quizzes a team has in its listed slots
+            siblings : quizzes a team has at the same time as another team in
+                its group is quizzing in another room (e.g. teams which share
+                a coach)
+            early_slots : quizzes a team has in the first `slots` slots, if it
+                has more than `max` of them
+            late_slots : the same, for the last `slots` slots
+        Each optional term can also be given a "weight" for its penalty.
+
+        The spec is compiled into per-team lookup tables, so terms which are
+        not used cost nothing while annealing.
+
+        Parameters
+        ----------
+        spec : dict
+            The energy spec
+
+        returns : self
+        """
+        for key in spec:
+            if not key in ("weights", "preferred_rooms", "unavailable", "siblings", "early_slots", "late_slots"):
+                raise ValueError("Unknown energy spec item: {}".format(key))
+        for name, weight in spec.get("weights", {}).items():
+            if not name in self.energy_terms:
+                raise ValueError("Unknown energy term: {}".format(name))
+            setattr(self, name, float(weight))
+
+        T, R, S = self.T, self.R, self.S
+        term = spec.get("preferred_rooms")
+        if term is not None:
+            self.preferred_room = float(term.get("weight", self.preferred_room))
+            self.room_cost = array('b',[0])*(T*R)
+            for t, rooms in term["teams"].items():
+                for ri in range(R):
+                    self.room_cost[int(t)*R+ri] = not ri in rooms
+
+        term = spec.get("unavailable")
+        if term is not None:
+            self.unavailable = float(term.get("weight", self.unavailable))
+            self.slot_cost = array('b',[0])*(T*S)
+            for t, slots in term["teams"].items():
+                for si in slots:
+                    self.slot_cost[int(t)*S+si] = 1
+
+        term = spec.get("siblings")
+        if term is not None:
+            self.sibling_conflict = float(term.get("weight", self.sibling_conflict))
+            # Groups which share a team are merged, and every other team is
+            #  in a group of its own
+            group = list(range(T))
+            def find(t):
+                while group[t] != t:
+                    t = group[t]
+                return t
+            for teams in term["groups"]:
+                for t in teams[1:]:
+                    group[find(t)] = find(teams[0])
+            roots = sorted(set(find(t) for t in range(T)))
+            self.sibling_group = array('h',[roots.index(find(t)) for t in range(T)])
+            self.siblings = [
+                [other for other in range(T) if other != t and self.sibling_group[other] == self.sibling_group[t]]
+                for t in range(T)
+            ]
+            G = self.nGroups = len(roots)
+            self.group_occupancy = array('h',[0])*(S*G)
+            for si in range(S):
+                for t in range(T):
+                    self.group_occupancy[si*G+self.sibling_group[t]] += self.occupancy[si*T+t]
+            self.sibling_events = array('i',[
+                sum(self._sibling_conflicts_in(t,si,ri) for si,ri in self.Tquiz[t]) for t in range(T)
+            ])
+
+        term = spec.get("early_slots")
+        if term is not None:
+            self.early_slots = float(term.get("weight", self.early_slots))
+            self.early_cap = (term["slots"], term["max"])
+
+        term = spec.get("late_slots")
+        if term is not None:
+            self.late_slots = float(term.get("weight", self.late_slots))
+            self.late_cap = (term["slots"], term["max"])
+
+        self.optional_terms = any(compiled is not None for compiled in (
+            self.room_cost, self.slot_cost, self.siblings, self.early_cap, self.late_cap
+        ))
+        self.hot = None
+        self.E = self.get_total_energy()
+        return self
+
+    def teams_in(self,si,ri):
+        """Returns the team indices in the quiz: self.draw[si][ri]
+        """
+        qi = si*self.R+ri
+        return self.seats[3*qi:3*qi+self.counts[qi]]
+
+    def _in_slot(self,t,si):
+        # True if team id `t` is quizzing in slot `si`, which is indexed (and
+        #  raises IndexError) the same way as `self.draw[si]`
+        if not -self.S <= si < self.S:
+            raise IndexError("slot index out of range")
+        return self.occupancy[(si % self.S)*self.T+t] > 0
+
+    def _generate_open(self,t):
         # Generate all the not filled quizzes
         slots_to_fill = ceil((self.Q) / self.R)
         for si in range(slots_to_fill):
@@ -163,20 +412,20 @@ class Prelims:
             else:
                 rooms_to_fill = self.R
             for ri in range(rooms_to_fill):
-                if not self.draw[si][ri].full:# and not char in q.s:
+                if self.counts[si*self.R+ri] < 3:
                     yield (si,ri)
 
-    def get_quiz_energy(self,char,si,ri):
+    def get_quiz_energy(self,t,si,ri):
         """Calaculates the 'energy' of a team being inserted into a quiz.
 
-        Note, this function assumes the team `char` is NOT already in quiz
-        'self.draw[si][ri]'. If it IS, you will need to call self.pop(char,si,ri)
-        then this function, the self.push(char,si,ri).
+        Note, this function assumes the team `t` is NOT already in quiz
+        'self.draw[si][ri]'. If it IS, you will need to call self.pop(t,si,ri)
+        then this function, the self.push(t,si,ri).
         """
 
         # Check for back-to-back
         try:
-            btb = any(char in q.s for q in self.draw[si-1])
+            btb = self._in_slot(t,si-1)
         except IndexError:
             # Happens for quizzes in the first slot
             btb = False
@@ -186,7 +435,7 @@ class Prelims:
 
         # Check for hat-tricks
         try:
-            ht = btb and any(char in q.s for q in self.draw[si-2])
+            ht = btb and self._in_slot(t,si-2)
         except IndexError:
             # Happens for quizzes in the first or second slot
             ht = False
@@ -195,26 +444,247 @@ class Prelims:
             ht = False
 
         # Check if a team is already quizzing
-        cq = any(char in q.s for _ri,q in enumerate(self.draw[si]))
+        cq = self._in_slot(t,si)
 
-        # Check the number of other times `char` is already quizzing the other
+        # Check the number of other times `t` is already quizzing the other
         #  teams in the quiz
+        pairs = self.pairs[t]
         seen = 0
-        for other_char in self.draw[si][ri].s:
-            for _si,_ri in self.Tquiz[other_char]:
-                if not (_si == si and _ri == ri) and char in self.draw[_si][_ri].s:
-                    seen += 1
+        for other in self.teams_in(si,ri):
+            if other != t:
+                seen += pairs.get(other,0)
 
-        # Check the number of other times `char` is quizzing in this room
+        # Check the number of other times `t` is quizzing in this room
         quizzed = 0
-        for _si,_ri in self.Tquiz[char]:
+        for _si,_ri in self.Tquiz[t]:
             quizzed += int(ri==_ri)
 
-        return cq*self.currently_quizzing\
+        # Check for teams from another division, and rooms `t`'s division can't use
+        cross = 0
+        if self.multidivision:
+            d = self.divisions[t]
+            cross = (not self.room_ok[d][ri]) + sum(self.divisions[other] != d for other in self.teams_in(si,ri))
+
+        E = cq*self.currently_quizzing\
                 + quizzed*self.already_quizzed\
                 + btb*self.back_to_back\
                 + ht*self.hat_trick\
-                + seen*self.already_seen
+                + seen*self.already_seen\
+                + cross*self.cross_division
+
+        # The optional terms of the energy spec
+        if not self.optional_terms:
+            return E
+        if self.room_cost is not None:
+            E += self.room_cost[t*self.R+ri]*self.preferred_room
+        if self.slot_cost is not None:
+            E += self.slot_cost[t*self.S+si]*self.unavailable
+        if self.siblings is not None:
+            E += self._sibling_conflicts_in(t,si,ri)*self.sibling_conflict
+        if self.early_cap is not None:
+            n, k = self.early_cap
+            if si < n:
+                E += (sum(_si < n for _si,_ri in self.Tquiz[t]) >= k)*self.early_slots
+        if self.late_cap is not None:
+            n, k = self.late_cap
+            if si >= self.S-n:
+                E += (sum(_si >= self.S-n for _si,_ri in self.Tquiz[t]) >= k)*self.late_slots
+        return E
+
+    def get_team_events(self,t):
+        """Counts the 'undesirable' events for each quiz of team id `t`
+
+        Returns a list of integer counts in the same order as `.energy_terms`:
+        [currently_quizzing, already_quizzed, back_to_back, hat_trick, already_seen,
+        cross_division, preferred_room, unavailable, sibling_conflict, early_slots,
+        late_slots],
+        which is exactly what .get_quiz_energy(...) would find for each of the
+        team's quizzes, summed up. Summing these counts over all of the teams
+        and weighting them gives the total energy of the draw.
+
+        Note, a team's events only depend on the quizzes which that team is in
+        (and the slots of its sibling teams), so interchanging teams (or
+        quizzes) only changes the events of the teams involved in the two
+        quizzes being interchanged, and their siblings (which are accounted
+        for by .get_local_events(...)).
+        """
+        seats, counts, R, S, T = self.seats, self.counts, self.R, self.S, self.T
+        positions = self.Tquiz[t]
+        # Number of times `t` is quizzing in each slot
+        slots = self.occupancy
+
+        # Number of times `t` is quizzing in each room
+        rooms = {}
+        for si,ri in positions:
+            rooms[ri] = rooms.get(ri,0) + 1
+
+        cq = quizzed = btb = ht = seen = 0
+        for si,ri in positions:
+            # Check if a team is already quizzing
+            cq += slots[si*T+t] > 1
+
+            # Check the number of other times `t` is quizzing in this room
+            quizzed += rooms[ri] - 1
+
+            # Check for back-to-back and hat-tricks, indexing the same way as
+            #  .get_quiz_energy(...) does
+            if si != self.breakindex:
+                _si = (si-1) % S
+                if slots[_si*T+t] - (_si == si) > 0:
+                    btb += 1
+                    if si-2 >= -S:
+                        _si = (si-2) % S
+                        ht += slots[_si*T+t] - (_si == si) > 0
+
+        # Check the number of other times `t` is quizzing the other teams in
+        #  each quiz, using the pair counts without the quiz itself
+        pairs = self.pairs[t]
+        for si,ri in positions:
+            qi = si*R+ri
+            s = seats[3*qi:3*qi+counts[qi]].tolist()
+            for other in s:
+                if other != t:
+                    seen += pairs[other] - s.count(other)
+
+        # Check for teams from another division, and rooms `t`'s division can't use
+        cross = 0
+        if self.multidivision:
+            d = self.divisions[t]
+            for si,ri in positions:
+                qi = si*R+ri
+                cross += not self.room_ok[d][ri]
+                for other in seats[3*qi:3*qi+counts[qi]]:
+                    cross += self.divisions[other] != d
+
+        # The optional terms of the energy spec
+        if not self.optional_terms:
+            return [cq, quizzed, btb, ht, seen, cross, 0, 0, 0, 0, 0]
+        room = unavailable = sibling = early = late = 0
+        if self.room_cost is not None:
+            for si,ri in positions:
+                room += self.room_cost[t*R+ri]
+        if self.slot_cost is not None:
+            for si,ri in positions:
+                unavailable += self.slot_cost[t*S+si]
+        if self.siblings is not None:
+            sibling = self.sibling_events[t]
+        if self.early_cap is not None:
+            n, k = self.early_cap
+            early = sum(si < n for si,ri in positions)
+            early = early if early > k else 0
+        if self.late_cap is not None:
+            n, k = self.late_cap
+            late = sum(si >= S-n for si,ri in positions)
+            late = late if late > k else 0
+
+        return [cq, quizzed, btb, ht, seen, cross, room, unavailable, sibling, early, late]
+
+    @property
+    def energy_weights(self):
+        # The energy penalties, in the order used by .get_team_events(...)
+        return [getattr(self,name) for name in self.energy_terms]
+
+    def get_local_events(self,teams,team_events = None):
+        """Sums the event counts of each team id in `teams`
+
+        If a dictionary `team_events` is given, the event counts of each team
+        are also saved into it.
+
+        Sibling conflicts are counted by both teams, so the conflicts between
+        a team in `teams` and a sibling which isn't are counted twice here
+        (by doubling the sibling counts, then taking off the conflicts between
+        siblings which are both in `teams`). That way, moving only the teams in
+        `teams` changes these sums by exactly the change in the total event
+        counts.
+        """
+        events = [0]*len(self.energy_terms)
+        for t in teams:
+            _events = self.get_team_events(t)
+            events = [n+m for n,m in zip(events,_events)]
+            if team_events is not None:
+                team_events[t] = _events
+        if self.siblings is not None:
+            events[8] *= 2
+            group, in_group = self.sibling_group, {}
+            for t in teams:
+                for other in in_group.setdefault(group[t],[]):
+                    # The same conflicts, counted by each team
+                    events[8] -= 2*self._sibling_conflicts(t,other)
+                in_group[group[t]].append(t)
+        return events
+
+    def _sibling_conflicts_in(self,t,si,ri):
+        # The number of quizzes the sibling teams of team id `t` have in slot
+        #  `si`, other than quiz `ri`
+        group = self.sibling_group
+        g = group[t]
+        qi = si*self.R+ri
+        n = self.group_occupancy[si*self.nGroups+g] - self.occupancy[si*self.T+t]
+        for other in self.seats[3*qi:3*qi+self.counts[qi]]:
+            n -= other != t and group[other] == g
+        return n
+
+    def _move_sibling(self,t,si,qi,sign):
+        # Update the group occupancy and sibling conflicts for team id `t`
+        #  being added to (sign = 1, before it's seated) or removed from (sign
+        #  = -1, after it's unseated) quiz `qi` in slot `si`
+        group, events, occupancy, T = self.sibling_group, self.sibling_events, self.occupancy, self.T
+        g = group[t]
+        gi = si*self.nGroups+g
+        if sign < 0:
+            self.group_occupancy[gi] -= 1
+        # `t` is in conflict with each quiz of its siblings in the slot, and
+        #  each of them with `t`, less the siblings in the quiz itself
+        events[t] += sign*(self.group_occupancy[gi] - occupancy[si*T+t])
+        for other in self.siblings[t]:
+            events[other] += sign*occupancy[si*T+other]
+        for other in self.seats[3*qi:3*qi+self.counts[qi]]:
+            if other != t and group[other] == g:
+                events[t] -= sign
+                events[other] -= sign
+        if sign > 0:
+            self.group_occupancy[gi] += 1
+
+    def _sibling_conflicts(self,t,other):
+        # The number of quizzes of team id `t` while team id `other` is
+        #  quizzing in another room, taking off the quizzes they share
+        occupancy, T = self.occupancy, self.T
+        n = -self.pairs[t].get(other,0)
+        for si,ri in self.Tquiz[t]:
+            n += occupancy[si*T+other]
+        return n
+
+    def _update_hot(self,team_events):
+        # Update which teams are "hot" from their event counts: those which are
+        #  quizzing in two places at once, have a hat trick, are crossing
+        #  divisions, are quizzing while unavailable or at the same time as a
+        #  sibling team in another room. Back-to-backs and repeated pairings
+        #  are left out, since most teams have some of those
+        if self.hot is None:
+            return
+        for t,events in team_events.items():
+            is_hot = events[0] or events[3] or events[5] or events[7] or events[8]
+            if is_hot and not t in self._hot_index:
+                self._hot_index[t] = len(self.hot)
+                self.hot.append(t)
+            elif not is_hot and t in self._hot_index:
+                # Swap the last hot team into the place of `t`
+                i, last = self._hot_index.pop(t), self.hot.pop()
+                if last != t:
+                    self.hot[i] = last
+                    self._hot_index[last] = i
+
+    def _build_hot(self):
+        # Find the "hot" teams from scratch
+        self.hot, self._hot_index = [], {}
+        self._update_hot({t:self.get_team_events(t) for t in range(self.T)})
+
+    def get_delta_energy(self,events_old,events_new):
+        """Calculates the change in energy between two sets of event counts
+        """
+        return sum(
+            w*(n-o) for w,o,n in zip(self.energy_weights,events_old,events_new)
+        )
 
     def get_total_energy(self):
         """Calculates the total energy of the draw
@@ -222,68 +692,174 @@ class Prelims:
         E = 0.0
         for si,s in enumerate(self.draw):
             for ri,q in enumerate(s):
-                for char in q.s:
-                    self.pop(char,si,ri)
-                    E += self.get_quiz_energy(char,si,ri)
-                    self.push(char,si,ri)
+                for t in self.teams_in(si,ri):
+                    self.pop(t,si,ri)
+                    E += self.get_quiz_energy(t,si,ri)
+                    self.push(t,si,ri)
         return E
 
-    def pop(self,char,si,ri):
-        """Remove a team `char` from the quiz: self.draw[ri][si]
+    def _pop(self,t,si,ri):
+        # Remove team id `t` from the quiz, keeping the seats packed
+        qi = si*self.R+ri
+        o, n = 3*qi, self.counts[qi]
+        i = self.seats[o:o+n].index(t)
+        self.seats[o+i:o+n-1] = self.seats[o+i+1:o+n]
+        self.seats[o+n-1] = -1
+        self.counts[qi] = n-1
+        self.Tquiz[t].remove((si,ri))
+        self.occupancy[si*self.T+t] -= 1
+        pairs = self.pairs
+        for other in self.seats[o:o+n-1]:
+            if other != t:
+                pairs[t][other] -= 1
+                pairs[other][t] -= 1
+        if self.sibling_group is not None:
+            self._move_sibling(t,si,qi,-1)
+        return t
+
+    def _push(self,t,si,ri):
+        # Add team id `t` to the quiz
+        qi = si*self.R+ri
+        n = self.counts[qi]
+        if n >= 3:
+            # Ensure that there are only ever three teams / quiz
+            raise ValueError("Quiz can only have 3 teams")
+        pairs = self.pairs
+        for other in self.seats[3*qi:3*qi+n]:
+            if other != t:
+                pairs[t][other] = pairs[t].get(other,0) + 1
+                pairs[other][t] = pairs[other].get(t,0) + 1
+        if self.sibling_group is not None:
+            self._move_sibling(t,si,qi,1)
+        self.seats[3*qi+n] = t
+        self.counts[qi] = n+1
+        self.Tquiz[t].append((si,ri))
+        self.occupancy[si*self.T+t] += 1
+
+    def pop(self,t,si,ri):
+        """Remove a team `t` from the quiz: self.draw[ri][si]
         """
-        try:
-            val = self.draw[si][ri].pop(self.draw[si][ri].s.index(char))
-        except Exception as E:
-            raise E
-        else:
-            self.Tquiz[char].pop(self.Tquiz[char].index((si,ri)))
+        self.hot = None
+        return self._pop(t,si,ri)
 
-        return val
-
-    def push(self,char,si,ri):
-        """Add a team `char` to the quiz: self.draw[ri][si]
+    def push(self,t,si,ri):
+        """Add a team `t` to the quiz: self.draw[ri][si]
         """
-        try:
-            self.draw[si][ri].push(char)
-        except Exception as E:
-            raise E
-        else:
-            self.Tquiz[char].append((si,ri))
+        self.hot = None
+        self._push(t,si,ri)
+
+    def _load_seats(self, seats, counts):
+        # Replace the draw with a copy of the `seats` and `counts` arrays, and
+        #  rebuild everything kept up to date by ._push(...)
+        self.seats[:] = array('h',[-1])*len(self.seats)
+        self.counts[:] = array('b',[0])*len(self.counts)
+        self.Tquiz = [[] for _ in range(self.T)]
+        self.pairs = [{} for _ in range(self.T)]
+        self.occupancy[:] = array('b',[0])*len(self.occupancy)
+        if self.sibling_group is not None:
+            self.group_occupancy[:] = array('h',[0])*len(self.group_occupancy)
+            self.sibling_events[:] = array('i',[0])*self.T
+        for qi in range(len(counts)):
+            for t in seats[3*qi:3*qi+counts[qi]]:
+                self._push(t,*divmod(qi,self.R))
+        self.hot = None
+        self.E = self.get_total_energy()
 
     def initialize(self):
         """Create an initial draw before thermalization
 
-        This function tries to create an rough guess at a good draw by iterating
-        through each team and trying to place it in the lowest energy spot available.
-        For a serial method, I think this is the best one can do.
+        This function builds a rough guess at a good draw one slot at a time,
+        filling each quiz with the teams which most need to quiz next. In order
+        of priority, a team is preferred if it:
+            - Isn't already quizzing in the slot
+            - Is in the same division as the first team in the quiz
+            - Is in a division which can use the room
+            - Has as many quizzes left as there are slots left
+            - Is available in the slot
+            - Has the fewest sibling teams quizzing in other rooms in the slot
+            - Didn't quiz in the previous slot (or the two before that)
+            - Has quizzed the other teams in the quiz the fewest times
+            - Prefers the room
+            - Has quizzed in the room the fewest times
+            - Has the most quizzes left
+        Each choice only looks at per-team counters, so this only takes a few
+        milliseconds, even for large meets.
 
         Note, this initial draw is deterministic (it will always turn out the
         same way).
 
+        Note, to keep this draw and refine it, rather than randomize it,
+        anneal from a low temperature, e.g. .anneal(N, kTmax = .refine_kTmax).
+
         Note, this initial draw does not gaurentee that a team won't be scheduled for
         two quizzes at the same time, but this will only happen if the draw parameters
         are 'tight' (meaning there isn't a lot of play: lots of rooms or not very
         many blank quizzes).
         """
-        for _ in range(self.qpt):
-            for char in self.Tlist:
-                E = [(si,ri,self.get_quiz_energy(char, si, ri)) for si,ri in self._generate_open(char)]
-                si,ri,E = sorted(E,key=lambda e: e[2])[0]
-                self.push(char,si,ri)
+        remaining = [self.qpt]*self.T
+        # The last two slots that each team quizzed in
+        last, before_last = [-3]*self.T, [-3]*self.T
+        rooms = [[0]*self.R for _ in range(self.T)]
+        met = [[0]*self.T for _ in range(self.T)]
+        slot_cost, room_cost, siblings = self.slot_cost, self.room_cost, self.siblings
+        group = self.sibling_group
+
+        slots_to_fill = ceil(self.Q / self.R)
+        for si in range(slots_to_fill):
+            slots_left = slots_to_fill - si
+            after_break = si == self.breakindex
+            for ri in range(min(self.R, self.Q - si*self.R)):
+                chosen = []
+                for _ in range(3):
+                    def priority(t):
+                        btb = (last[t] == si-1) and not after_break
+                        d = self.divisions[t]
+                        return (
+                            last[t] == si,
+                            bool(chosen) and d != self.divisions[chosen[0]],
+                            not self.room_ok[d][ri],
+                            remaining[t] < slots_left,
+                            slot_cost is not None and slot_cost[t*self.S+si],
+                            siblings is not None and self.group_occupancy[si*self.nGroups+group[t]]
+                                - self.occupancy[si*self.T+t] - sum(other != t and group[other] == group[t] for other in chosen),
+                            btb + (btb and before_last[t] == si-2),
+                            sum(met[t][other] for other in chosen),
+                            room_cost is not None and room_cost[t*self.R+ri],
+                            rooms[t][ri],
+                            -remaining[t],
+                            t
+                        )
+                    teams = [t for t in range(self.T) if remaining[t] > 0 and t not in chosen]\
+                        or [t for t in range(self.T) if remaining[t] > 0]
+                    t = min(teams, key=priority)
+
+                    self._push(t,si,ri)
+                    remaining[t] -= 1
+                    if last[t] != si:
+                        last[t], before_last[t] = si, last[t]
+                    rooms[t][ri] += 1
+                    for other in chosen:
+                        met[t][other] += 1
+                        met[other][t] += 1
+                    chosen.append(t)
+
         self.E = self.get_total_energy()
         return self
 
-    def interchange_team(self,char1,si1,ri1,char2,si2,ri2,kT = 1.0):
+    def interchange_team(self,t1,si1,ri1,t2,si2,ri2,kT = 1.0):
         """Attempt to interchange two teams using the Metropolis Algorithm
         """
+        # Only the teams in the two quizzes can have their energy changed
+        teams = set(self.teams_in(si1,ri1) + self.teams_in(si2,ri2))
+        events_old = self.get_local_events(teams)
         # Interchange two teams
-        self.pop(char1,si1,ri1)
-        self.pop(char2,si2,ri2)
-        self.push(char2, si1, ri1)
-        self.push(char1, si2, ri2)
-        # Get the new total energy
-        Enew = self.get_total_energy()
-        deltaE = Enew-self.E
+        self._pop(t1,si1,ri1)
+        self._pop(t2,si2,ri2)
+        self._push(t2, si1, ri1)
+        self._push(t1, si2, ri2)
+        # Get the change in energy
+        team_events = {}
+        deltaE = self.get_delta_energy(events_old, self.get_local_events(teams,team_events))
         try:
             prob = exp(-(deltaE)/kT)
         except (ZeroDivisionError, OverflowError):
@@ -291,17 +867,19 @@ class Prelims:
         if deltaE < 0:
             # Accept the interchange
             self.E += deltaE
+            self._update_hot(team_events)
             return True, deltaE
-        elif random() < prob:
+        elif self.rng.random() < prob:
             # Accept the interchange
             self.E += deltaE
+            self._update_hot(team_events)
             return True, deltaE
         else:
             # Reject the interchange
-            self.pop(char2, si1, ri1)
-            self.pop(char1, si2, ri2)
-            self.push(char1, si1, ri1)
-            self.push(char2, si2, ri2)
+            self._pop(t2, si1, ri1)
+            self._pop(t1, si2, ri2)
+            self._push(t1, si1, ri1)
+            self._push(t2, si2, ri2)
             return False, deltaE
 
     def interchange_quiz(self,qn1,qn2,kT = 1.0):
@@ -312,22 +890,26 @@ class Prelims:
         si1,ri1 = qn1 // self.R, qn1 % self.R
         si2,ri2 = qn2 // self.R, qn2 % self.R
 
+        # Only the teams in the two quizzes can have their energy changed
+        teams = set(self.teams_in(si1,ri1) + self.teams_in(si2,ri2))
+        events_old = self.get_local_events(teams)
+
         # Interchange the two quizzes
-        char1 = []
-        for char in self.draw[si1][ri1].s:
-            char1.append(self.pop(char,si1,ri1))
-        char2 = []
-        for char in self.draw[si2][ri2].s:
-            char2.append(self.pop(char,si2,ri2))
-
-        for char in char1:
-            self.push(char,si2,ri2)
-        for char in char2:
-            self.push(char,si1,ri1)
-
-        # Get the new total energy
-        Enew = self.get_total_energy()
-        deltaE = Enew-self.E
+        teams1 = []
+        for t in self.teams_in(si1,ri1):
+            teams1.append(self._pop(t,si1,ri1))
+        teams2 = []
+        for t in self.teams_in(si2,ri2):
+            teams2.append(self._pop(t,si2,ri2))
+
+        for t in teams1:
+            self._push(t,si2,ri2)
+        for t in teams2:
+            self._push(t,si1,ri1)
+
+        # Get the change in energy
+        team_events = {}
+        deltaE = self.get_delta_energy(events_old, self.get_local_events(teams,team_events))
         try:
             prob = exp(-(deltaE)/kT)
         except (ZeroDivisionError, OverflowError):
@@ -335,122 +917,740 @@ class Prelims:
         if deltaE < 0:
             # Accept the interchange
             self.E += deltaE
+            self._update_hot(team_events)
             return True, deltaE
-        elif random() < prob:
+        elif self.rng.random() < prob:
             # Accept the interchange
             self.E += deltaE
+            self._update_hot(team_events)
             return True, deltaE
         else:
             # Reject the interchange
-            for char in char1:
-                self.pop(char,si2,ri2)
-            for char in char2:
-                self.pop(char,si1,ri1)
-            for char in char1:
-                self.push(char,si1,ri1)
-            for char in char2:
-                self.push(char,si2,ri2)
+            for t in teams1:
+                self._pop(t,si2,ri2)
+            for t in teams2:
+                self._pop(t,si1,ri1)
+            for t in teams1:
+                self._push(t,si1,ri1)
+            for t in teams2:
+                self._push(t,si2,ri2)
             return False, deltaE
 
     def _thermalization_step(self,kT = 1.0, alpha = 0.1):
         """Iterate once through the Metropolis Algorithm
+
+        With probability `.hot_bias`, the interchange is targeted at one of the
+        "hot" teams, so that the moves are spent where the draw has problems.
+        Note, this biases the proposals, so the draw is no longer sampled from
+        the exact Boltzmann distribution, which doesn't matter for optimizing.
         """
-        if random() > alpha:
+        if self.hot is None:
+            self._build_hot()
+        # Pick a hot team to target, if there are any
+        hot = None
+        if self.hot and self.rng.random() < self.hot_bias:
+            hot = self.hot[self.rng.randint(0,len(self.hot)-1)]
+
+        if self.rng.random() > alpha:
             # Try a team interchange
-            ci1,ci2 = randint(0,self.T-1),randint(1,self.T-1)
+            ci1,ci2 = self.rng.randint(0,self.T-1),self.rng.randint(1,self.T-1)
+            if hot is not None:
+                ci1 = hot
             ci2 = (ci1 + ci2) % self.T
-            char1,char2 = self.Tlist[ci1],self.Tlist[ci2]
-            qi1,qi2 = randint(0,self.qpt-1), randint(0,self.qpt-1)
-            si1,ri1 = self.Tquiz[char1][qi1]
-            si2,ri2 = self.Tquiz[char2][qi2]
-            return self.interchange_team(char1,si1,ri1,char2,si2,ri2,kT=kT)
+            qi1,qi2 = self.rng.randint(0,self.qpt-1), self.rng.randint(0,self.qpt-1)
+            si1,ri1 = self.Tquiz[ci1][qi1]
+            si2,ri2 = self.Tquiz[ci2][qi2]
+            return self.interchange_team(ci1,si1,ri1,ci2,si2,ri2,kT=kT)
         else:
             # Try a quiz interchange
-            qn1,qn2 = randint(0,self.Q+self.B-1),randint(0,self.Q+self.B-1)
+            qn1,qn2 = self.rng.randint(0,self.Q+self.B-1),self.rng.randint(0,self.Q+self.B-1)
+            if hot is not None:
+                si1,ri1 = self.Tquiz[hot][self.rng.randint(0,self.qpt-1)]
+                qn1 = si1*self.R+ri1
             return self.interchange_quiz(qn1,qn2,kT=kT)
 
-    def thermalize(self, N, kT = 0.5, alpha = 0.1,verbose=False):
+    def _progress_metrics(self):
+        # Summarize the draw quality for the progress printouts
+        metrics = self.get_metrics()
+        line = " : CQ = {} : BTB = {} : HT = {}".format(
+            sum(metrics['conflicts']),
+            sum(metrics['back_to_back']),
+            sum(metrics['hat_tricks'])
+        )
+        if self.multidivision:
+            line += " : XD = {}".format(sum(metrics['cross_division']))
+        return line
+
+    def _metropolis(self, schedule, alpha, verbose, show_kT, window = 1000, patience = None, patience_kT = None, min_acceptance = None, target_energy = None, target_metrics = None, checkpoint = None, checkpoint_every = 10000, backend = None, resume = False):
+        """Run the Metropolis Algorithm through a schedule of temperatures
+
+        This is shared by .thermalize(...) and .anneal(...), which both accept
+        these optional early stopping criteria:
+            patience : stop once the energy hasn't improved for this many steps,
+                only counting the steps at or below `patience_kT` (None uses
+                10x the coldest temperature of the schedule, so an anneal only
+                starts counting once it has cooled down)
+            min_acceptance : stop once the fraction of accepted interchanges
+                over the last `window` steps falls below this
+            target_energy : stop once the energy is at or below this
+            target_metrics : stop once the totals of the .get_metrics() counts
+                are at or below these, e.g. {"conflicts":0, "hat_tricks":0},
+                which is checked every `window` steps
+        The reason the run stopped is saved as `.stop_reason` ("steps" if it
+        ran through every temperature), and the number of steps as `.steps_run`.
+        If the run stops early for patience, min_acceptance or target_energy,
+        the lowest energy draw seen during the run is restored (target_metrics
+        keeps the draw which met the targets).
+
+        They also both accept:
+            checkpoint : a file path, which the full state of the run is saved
+                to every `checkpoint_every` steps, when the run ends and if it
+                is interrupted by Ctrl-C (after finishing the current step).
+                The run can then be picked back up with
+                `Prelims.resume(checkpoint)`
+            backend : "auto", "python" or "kernel", which overrides
+                `.backend` (see `.backend` for the options)
+        """
+        kT_list = _kT_list(schedule)
+        N = len(kT_list)
+        if resume:
+            run = self._run
+        else:
+            run = {
+                "args": (schedule, alpha, verbose, show_kT),
+                "kwargs": {
+                    "window": window,
+                    "patience": patience,
+                    "patience_kT": patience_kT,
+                    "min_acceptance": min_acceptance,
+                    "target_energy": target_energy,
+                    "target_metrics": target_metrics,
+                    "checkpoint": checkpoint,
+                    "checkpoint_every": checkpoint_every,
+                    "backend": backend
+                },
+                "step": 0,
+                "best": self.E,
+                "since_best": 0,
+                "accepted": 0
+            }
+            if patience is not None or min_acceptance is not None or target_energy is not None:
+                # A copy of the lowest energy draw, to go back to if the run
+                #  stops early
+                run['best_seats'], run['best_counts'] = array('h',self.seats), array('b',self.counts)
+            self._run = run
+            self.stop_reason, self.steps_run = "steps", 0
+        best, since_best, accepted = run['best'], run['since_best'], run['accepted']
+        keep_best = "best_seats" in run
+        if patience_kT is None:
+            patience_kT = 10*min(kT_list)
+
+        # Run the steps through the compiled kernel if possible (see
+        #  statsimusprime/draw_kernel.py), otherwise one by one in Python
+        backend = backend or self.backend
+        if not backend in ("auto", "python", "kernel"):
+            raise ValueError("Unknown backend: {}".format(backend))
+        kernel = None
+        if backend == "kernel" or (backend == "auto" and draw_kernel.COMPILED):
+            if not self.optional_terms:
+                kernel = self._kernel_state(run)
+            elif backend == "kernel":
+                raise ValueError("The kernel doesn't support the optional energy terms")
+
+        # Hold off on Ctrl-C until the current step is finished, so that the
+        #  checkpoint isn't saved in the middle of an interchange
+        interrupted = []
+        handler = None
+        if checkpoint is not None and threading.current_thread() is threading.main_thread():
+            handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+        try:
+            p = max(1,N//20)
+            i = run['step']
+            while i < N:
+                if kernel is None:
+                    accepted += self._thermalization_step(kT_list[i],alpha)[0]
+                    i += 1
+                    if self.E < best - 1e-9:
+                        best, since_best = self.E, 0
+                        if keep_best:
+                            run['best_seats'][:], run['best_counts'][:] = self.seats, self.counts
+                    elif kT_list[i-1] <= patience_kT:
+                        since_best += 1
+                    if target_energy is not None and self.E <= target_energy:
+                        self.stop_reason = "target_energy"
+                    elif patience is not None and since_best >= patience:
+                        self.stop_reason = "patience"
+                else:
+                    # Run up to the next step where something has to be done
+                    #  in Python
+                    stop = N
+                    if verbose:
+                        stop = min(stop, (i//p+1)*p)
+                    if min_acceptance is not None or target_metrics is not None:
+                        stop = min(stop, (i//window+1)*window)
+                    if checkpoint is not None:
+                        stop = min(stop, (i//checkpoint_every+1)*checkpoint_every)
+                    self.E, _accepted, steps, best, since_best, code, run['kernel_nhot'] = draw_kernel.run(
+                        *kernel,
+                        run['kernel_nhot'],
+                        *draw_kernel.buffers(array('d',kT_list[i:stop])),
+                        alpha,
+                        self.hot_bias,
+                        self.E,
+                        best,
+                        since_best,
+                        -float('inf') if target_energy is None else target_energy,
+                        -1 if patience is None else patience,
+                        patience_kT,
+                        keep_best
+                    )
+                    accepted += _accepted
+                    i += steps
+                    self.stop_reason = ("steps", "target_energy", "patience")[code]
+                    self._load_kernel_state(kernel, run)
+                self.steps_run = i
+
+                if i % p == 0 or i == N:
+                    if verbose and show_kT:
+                        print("{: >3}% : kT = {: >1.3f} : E = {:.1f} : E/T = {:.2f} : E/Q = {:.3f}".format(100*i//N, kT_list[i-1],self.E,self.E/self.T,self.E/(3*self.Q))+self._progress_metrics())
+                    elif verbose:
+                        print("{: >3}% : E = {:.1f} : E/T = {:.2f} : E/Q = {:.3f}".format(100*i//N,self.E,self.E/self.T,self.E/(3*self.Q))+self._progress_metrics())
+
+                # Check the early stopping criteria, which are checked once
+                #  every `window` steps
+                if self.stop_reason == "steps" and i % window == 0:
+                    if min_acceptance is not None and accepted/window < min_acceptance:
+                        self.stop_reason = "min_acceptance"
+                    elif target_metrics is not None:
+                        metrics = self.get_metrics()
+                        if all(sum(metrics[k]) <= v for k,v in target_metrics.items()):
+                            self.stop_reason = "target_metrics"
+                    accepted = 0
+
+                run.update(step = i, best = best, since_best = since_best, accepted = accepted)
+                if self.stop_reason != "steps":
+                    break
+                if interrupted:
+                    self.save_checkpoint(checkpoint)
+                    print("Interrupted after {} steps, resume with Prelims.resume({!r})".format(self.steps_run, checkpoint))
+                    raise KeyboardInterrupt
+                if checkpoint is not None and i % checkpoint_every == 0:
+                    self.save_checkpoint(checkpoint)
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGINT, handler)
+
+        if self.stop_reason in ("patience", "min_acceptance", "target_energy") and best < self.E - 1e-9:
+            self._load_seats(run['best_seats'], run['best_counts'])
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
+        if verbose and self.stop_reason != "steps":
+            print("Stopped after {} steps : {}".format(self.steps_run, self.stop_reason))
+        return self
+
+    def _kernel_state(self, run):
+        # The arguments of draw_kernel.run(...) which hold the state of the
+        #  draw (or are fixed), in order. The seats, counts and occupancy are
+        #  shared with the draw
+        T, R = self.T, self.R
+        assert all(len(positions) == self.qpt for positions in self.Tquiz), "Every team needs QpT quizzes"
+        tq = array('i',[si*R+ri for positions in self.Tquiz for si,ri in positions])
+        pairs = array('i',[0])*(T*T)
+        for t in range(T):
+            for other,n in self.pairs[t].items():
+                pairs[t*T+other] = n
+        if not "kernel_rng" in run:
+            run['kernel_rng'] = self.rng.getrandbits(48)
+        # The hot teams are carried from one call of the kernel to the next
+        #  (and saved with checkpoints), so that the run doesn't depend on how
+        #  it is split up
+        hot, hot_index = array('i',[-1])*T, array('i',[-1])*T
+        if "kernel_hot" in run:
+            for i,t in enumerate(run['kernel_hot']):
+                hot[i], hot_index[t] = t, i
+            run['kernel_nhot'] = len(run['kernel_hot'])
+        else:
+            run['kernel_nhot'] = -1
+        return draw_kernel.buffers(
+            self.seats,
+            self.counts,
+            self.occupancy,
+            pairs,
+            tq,
+            array('i',self.divisions),
+            array('b',[ok for room_ok in self.room_ok for ok in room_ok]),
+            array('d',self.energy_weights[:6]),
+            hot,
+            hot_index,
+            array('i',[0])*6,
+            array('i',[0])*6,
+            array('i',[0])*6,
+            array('q',[run['kernel_rng']]),
+            run.get('best_seats', array('h')),
+            run.get('best_counts', array('b')),
+            T,
+            R,
+            self.S,
+            self.qpt,
+            self.Q+self.B,
+            self.breakindex,
+            self.multidivision
+        )
+
+    def _load_kernel_state(self, kernel, run):
+        # Rebuild the team indices from the state of draw_kernel.run(...), the
+        #  seats, counts and occupancy arrays are shared
+        R, QpT = self.R, self.qpt
+        tq = kernel[4]
+        self.Tquiz = [[divmod(qi,R) for qi in tq[t*QpT:(t+1)*QpT].tolist()] for t in range(self.T)]
+        self.pairs = [{} for _ in range(self.T)]
+        for qi in range(self.S*R):
+            s = self.seats[3*qi:3*qi+self.counts[qi]].tolist()
+            for i,t in enumerate(s):
+                for k,other in enumerate(s):
+                    if i != k and t != other:
+                        self.pairs[t][other] = self.pairs[t].get(other,0) + 1
+        self.hot = None
+        run['kernel_rng'] = int(kernel[13][0])
+        run['kernel_hot'] = kernel[8][:run['kernel_nhot']].tolist()
+
+    def save_checkpoint(self, file_path):
+        """Save the full state of the draw and its optimizer to a file
+
+        This includes the draw, the energy, the random number generator state
+        and the position in the current .anneal(...) or .thermalize(...) run,
+        which can be continued with `Prelims.resume(file_path)`.
+        """
+        # Write to a temporary file first, so that an interruption can't leave
+        #  a half written checkpoint behind
+        with open(file_path+".tmp", "wb") as f:
+            pickle.dump(self, f)
+        os.replace(file_path+".tmp", file_path)
+        return self
+
+    @classmethod
+    def load_checkpoint(cls, file_path):
+        """Load a draw saved by `.save_checkpoint(file_path)`
+        """
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def resume(cls, file_path, verbose = None):
+        """Load a checkpoint and continue the run it was saved from
+
+        The run picks up at the step it was saved at, with the same schedule,
+        early stopping criteria and random number generator state, and keeps
+        saving checkpoints to the same file. A finished run is simply loaded.
+
+        Parameters
+        ----------
+        file_path : str
+            The checkpoint file, see the `checkpoint` argument of .anneal(...)
+
+        verbose : boolean or None : default = None
+            Whether to print the progress, None uses the original setting
+
+        returns : Prelims
+        """
+        prelim = cls.load_checkpoint(file_path)
+        run = prelim._run
+        if run is None or prelim.stop_reason != "steps" or run['step'] >= len(_kT_list(run['args'][0])):
+            return prelim
+        schedule, alpha, _verbose, show_kT = run['args']
+        if verbose is None:
+            verbose = _verbose
+        return prelim._metropolis(schedule, alpha, verbose, show_kT, resume = True, **run['kwargs'])
+
+    def thermalize(self, N, kT = 0.5, alpha = 0.1,verbose=False, **criteria):
         """Run through the Metropolis Algorithm to randomize the draw
+
+        See ._metropolis(...) for the optional early stopping `criteria`, and
+        for saving checkpoints
+        """
+        return self._metropolis(("constant", N, kT), alpha, verbose, False, **criteria)
+
+    def anneal(self, N, kTmax = 5, kTmin = 1e-3, alpha = 0.2, verbose = False, log = True, **criteria):
+        """Run through the Simulated Annealing algorithm to randomize the draw
+
+        See ._metropolis(...) for the optional early stopping `criteria`, and
+        for saving checkpoints
+        """
+        return self._metropolis(("log" if log else "linear", N, kTmax, kTmin), alpha, verbose, True, **criteria)
+
+    def temper(self, N, nReplicas = 8, kTmax = 5, kTmin = 1e-3, alpha = 0.2, exchange_every = 1000, processes = None, verbose = False):
+        """Run through the Parallel Tempering (replica exchange) algorithm
+
+        Copies of the draw ("replicas") are thermalized at a ladder of fixed
+        temperatures, log spaced from kTmax to kTmin, each in its own worker
+        process. Every `exchange_every` steps, replicas at neighbouring
+        temperatures attempt to swap their draws, which is accepted with
+        probability:
+            min(1, exp((1/kTi - 1/kTj)*(Ei - Ej)))
+        This lets draws stuck in a local minimum at low temperatures get
+        reheated, and good draws found at high temperatures sink down the
+        ladder. The lowest energy draw found by any replica is loaded into
+        this object at the end.
+
+        Parameters
+        ----------
+        N : int
+            The number of thermalization steps for each replica
+
+        nReplicas : int : default = 8
+            The number of temperatures in the ladder
+
+        exchange_every : int : default = 1000
+            The number of steps each replica takes between exchanges
+
+        processes : int or None : default = None
+            The number of worker processes, None uses every cpu
         """
-        j = 0
-        for i in range(N):
-            self._thermalization_step(kT=kT,alpha=alpha)
-            if (i % (N//20)) == 0:
-                j += 1
+        lkTmax,lkTmin = log10(kTmax), log10(kTmin)
+        step = (lkTmin-lkTmax)/max(1,nReplicas-1)
+        kT_list = [10.0**(lkTmax + step*i) for i in range(nReplicas)]
+
+        replicas = [deepcopy(self) for _ in kT_list]
+        best = deepcopy(self)
+        rounds = ceil(N/exchange_every)
+        pool = Pool(processes) if processes != 1 else None
+        try:
+            for r in range(rounds):
+                # Thermalize every replica at its own temperature
+                jobs = [
+                    (replica, exchange_every, kT, alpha, self.rng.randint(0,2**31))
+                    for replica,kT in zip(replicas,kT_list)
+                ]
+                if pool is None:
+                    replicas = [_thermalize_replica(job) for job in jobs]
+                else:
+                    replicas = pool.map(_thermalize_replica, jobs)
+
+                # Keep track of the best draw found so far
+                for replica in replicas:
+                    if replica.E < best.E:
+                        best = deepcopy(replica)
+
+                # Attempt to exchange neighbouring replicas, alternating between
+                #  the even and odd pairs each round
+                swapped = 0
+                for i in range(r % 2, nReplicas-1, 2):
+                    delta = (1/kT_list[i] - 1/kT_list[i+1])*(replicas[i].E - replicas[i+1].E)
+                    if delta >= 0 or self.rng.random() < exp(delta):
+                        replicas[i], replicas[i+1] = replicas[i+1], replicas[i]
+                        swapped += 1
+
                 if verbose:
-                    print("{: >3}% : E = {:.1f} : E/T = {:.2f} : E/Q = {:.3f}".format(5*j,self.E,self.E/self.T,self.E/(3*self.Q)))
+                    print("{: >3}% : E = {:.1f} : Ebest = {:.1f} : swaps = {}".format(
+                        int(100*(r+1)/rounds),
+                        min(replica.E for replica in replicas),
+                        best.E,
+                        swapped
+                    ))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Adopt the best draw, the `Quiz` views come along with the seat arrays
+        self.__dict__.update(best.__dict__)
         return self
 
-    def anneal(self, N, kTmax = 5, kTmin = 1e-3, alpha = 0.2, verbose = False, log = True):
-        """Run through the Simulated Annealing algorithm to randomize the draw
+    def solve(self, time_limit = 10.0, fallback_steps = 10**4, workers = None, verbose = False):
+        """Find the lowest energy draw with an exact solver
+
+        The draw is written as a constraint program and solved by the CP-SAT
+        solver of OR-Tools (see statsimusprime/draw_solver.py), which is only
+        practical for small meets (about 9 to 15 teams). Teams quizzing in two
+        places at once or across divisions are ruled out entirely, rather than
+        penalized.
+
+        The solver rarely proves a draw optimal within a few seconds, so it
+        starts from the current draw, or if the draw is empty, from an
+        initialized and annealed one. The solver's draw is only kept if it has
+        a lower energy than that starting draw. If OR-Tools isn't installed,
+        or the solver doesn't find a draw within the time limit (or proves that
+        there isn't one without conflicts), the starting draw is annealed (if
+        it wasn't already) and kept.
+
+        The outcome is saved as `.solve_status`: "optimal" (the draw has the
+        lowest possible energy), "feasible" (the best draw found before the
+        time limit, which beat the starting draw) or "annealed" (the starting
+        draw was kept). `.solve_bound` is the lowest energy any draw can have,
+        as proven by the solver (None if the solver didn't find a draw).
+
+        Parameters
+        ----------
+        time_limit : float : default = 10.0
+            The time limit of the solver in seconds
+
+        fallback_steps : int : default = 10**4
+            The number of annealing steps for the starting draw
+
+        workers : int or None : default = None
+            The number of solver threads, None lets the solver decide
+
+        returns : self
         """
-        if log:
-            lkTmax,lkTmin = log10(kTmax), log10(kTmin)
-            step = (lkTmin-lkTmax)/N
-            kT_list = [10.0**(lkTmax + step*i) for i in range(N)]
+        annealed = sum(self.counts) == 0
+        if annealed:
+            self.initialize().anneal(fallback_steps, kTmax = self.refine_kTmax, verbose = verbose)
+        status, teams, self.solve_bound = "unavailable", None, None
+        if draw_solver.HAVE_ORTOOLS:
+            status, teams, _, self.solve_bound = draw_solver.solve(self, time_limit, workers, verbose)
+        self.solve_status = "annealed"
+        if teams is None:
+            if verbose:
+                print("No draw from the solver ({}), annealing instead".format(status))
+            if not annealed:
+                self.anneal(fallback_steps, verbose = verbose)
+            return self
+
+        # Load the solution into the draw, unless the starting draw is better
+        seats, counts, E = array('h',self.seats), array('b',self.counts), self.E
+        for si,s in enumerate(self.draw):
+            for ri,q in enumerate(s):
+                for t in self.teams_in(si,ri):
+                    self.pop(t,si,ri)
+                for t in teams[si*self.R+ri]:
+                    self.push(t,si,ri)
+        self.E = self.get_total_energy()
+        if verbose:
+            print("Solver draw ({}) : E = {:.2f} : lower bound = {:.2f}".format(status, self.E, self.solve_bound))
+        if self.E < E - 1e-9:
+            self.solve_status = status
         else:
-            step = (kTmin-kTmax)/N
-            kT_list = [kTmax + step*i for i in range(N)]
-        j = 0
-        for i,kT in enumerate(kT_list):
-            self._thermalization_step(kT,alpha)
-            if (i % (N//20)) == 0:
-                j += 1
-                if verbose:
-                    print("{: >3}% : kT = {: >1.3f} : E = {:.1f} : E/T = {:.2f} : E/Q = {:.3f}".format(5*j, kT,self.E,self.E/self.T,self.E/(3*self.Q)))
+            if verbose:
+                print("Keeping the starting draw : E = {:.2f}".format(E))
+            self._load_seats(seats, counts)
         return self
 
+    @classmethod
+    def multistart(cls, N, nChains, *args, processes = None, seed = None, **kwargs):
+        """Anneal several independent draws in parallel and keep the best one
+
+        Each chain is created with `cls(*args).initialize()`, annealed with
+        `.anneal(N, **kwargs)` in its own worker process and given the seed
+        `seed + i`, where `i` is the index of the chain.
+
+        Parameters
+        ----------
+        N : int
+            The number of annealing steps for each chain
+
+        nChains : int
+            The number of independent annealing chains
+
+        processes : int or None : default = None
+            The number of worker processes, None uses every cpu
+
+        seed : int or None : default = None
+            The seed of the first chain, None picks one at random
+
+        returns : (Prelims, list)
+            The lowest energy draw, and the final energy of every chain
+        """
+        seed = randint(0,2**31) if seed is None else seed
+        jobs = [(cls, args, N, kwargs, seed+i) for i in range(nChains)]
+        if nChains == 1 or processes == 1:
+            chains = [_anneal_chain(job) for job in jobs]
+        else:
+            with Pool(processes) as pool:
+                chains = pool.map(_anneal_chain, jobs)
+        energies = [chain.E for chain in chains]
+        return chains[energies.index(min(energies))], energies
+
+    @classmethod
+    def scenarios(cls, nTeams, grid, N = 10**4, processes = None, seed = None, minutes_per_quiz = 20, **kwargs):
+        """Draw and compare several meet layouts ("what-if" scenarios) in parallel
+
+        Each scenario is drawn with `cls(nTeams, QpT, nRooms, breakloc,
+        numblanks, seed, **kwargs).initialize().anneal(N)` in its own worker
+        process. Nothing is written to disk.
+
+        Parameters
+        ----------
+        nTeams : int
+            The number of teams at the meet
+
+        grid : dict or list
+            Either a dictionary of lists of values to try for each of "nRooms",
+            "QpT", "numblanks" and "breakloc", every combination of which is a
+            scenario (missing keys use the defaults: 4 rooms, 6 quizzes per
+            team, the blanks which fill up the draw and no break), or a list
+            of dictionaries, each one a scenario.
+            e.g. {"nRooms": [4, 5], "QpT": [6, 9]}
+
+        N : int : default = 10**4
+            The number of annealing steps for each scenario
+
+        processes : int or None : default = None
+            The number of worker processes, None uses every cpu
+
+        seed : int or None : default = None
+            The seed of every scenario, None picks one at random
+
+        minutes_per_quiz : int : default = 20
+            The length of each slot, used for the makespan
+
+        returns : list of obj = {
+            nRooms, QpT, numblanks, breakloc : the scenario
+            energy : float, the energy of the draw
+            slots : int, the number of slots in the prelims
+            slots_before_break : int, the number of slots before the day break
+            makespan : int, minutes of prelim quizzing (not counting the break)
+            conflicts, back_to_back, hat_tricks : int, totals over the teams
+            error : str or None, why the scenario can't be drawn, in which case
+                the values above are None
+        }
+            One for each scenario, in order
+        """
+        if isinstance(grid, dict):
+            keys = ("nRooms", "QpT", "numblanks", "breakloc")
+            scenarios = [{}]
+            for key in keys:
+                scenarios = [dict(sc, **{key: v}) for sc in scenarios for v in grid.get(key, [None])]
+        else:
+            scenarios = [dict(sc) for sc in grid]
+        for sc in scenarios:
+            sc['nRooms'] = sc.get('nRooms') or 4
+            sc['QpT'] = sc.get('QpT') or 6
+            sc.setdefault('numblanks', None)
+            sc.setdefault('breakloc', None)
+
+        seed = randint(0,2**31) if seed is None else seed
+        jobs = [(cls, nTeams, sc, N, seed, minutes_per_quiz, kwargs) for sc in scenarios]
+        if len(jobs) == 1 or processes == 1:
+            return [_evaluate_scenario(job) for job in jobs]
+        with Pool(processes) as pool:
+            return pool.map(_evaluate_scenario, jobs)
+
+    def get_metrics(self):
+        """Calculate the draw quality metrics in a single pass over the draw
+
+        This is cheap enough to be called periodically while annealing. All
+        the per-team values are lists indexed by team id.
+
+        returns : obj = {
+            rooms : T x R, times each team quizzes in each room
+            pairs : T x T, times each team quizzes each other team, read from
+                `.pairs` (the diagonal is the number of quizzes of each team)
+            conflicts : T, extra quizzes each team has in slots where it is
+                already quizzing
+            back_to_back : T, times each team quizzes in two consecutive slots
+            hat_tricks : T, times each team quizzes in three consecutive slots
+            cross_division : T, quizzes each team has against another division
+                or in a room its division can't use
+            energy : float, the current energy of the draw
+        }
+        Along with a T list of counts for each optional term switched on by
+        the energy spec (see .get_team_events(...)).
+
+        Back-to-backs and hat tricks are not counted across the day break.
+        """
+        T, R, S = self.T, self.R, self.S
+        seats, counts = self.seats, self.counts
+        rooms = array('i',[0])*(T*R)
+        cross_division = array('i',[0])*T
+        divisions = self.divisions
+        for qi in range(S*R):
+            n = counts[qi]
+            if n == 0:
+                continue
+            si,ri = divmod(qi,R)
+            s = seats[3*qi:3*qi+n].tolist()
+            members = set(s)
+            for t in s:
+                rooms[t*R+ri] += 1
+                d = divisions[t]
+                cross_division[t] += (not self.room_ok[d][ri]) or any(divisions[other] != d for other in members)
+
+        conflicts = array('i',[0])*T
+        back_to_back = array('i',[0])*T
+        hat_tricks = array('i',[0])*T
+        for t in range(T):
+            # Length of the current run of consecutive slots `t` quizzes in
+            run = 0
+            for si,n in enumerate(self.occupancy[t::T]):
+                if n == 0:
+                    run = 0
+                    continue
+                conflicts[t] += n-1
+                run = 1 if si == self.breakindex else run+1
+                back_to_back[t] += run >= 2
+                hat_tricks[t] += run >= 3
+
+        metrics = {
+            "rooms": [rooms[t*R:(t+1)*R].tolist() for t in range(T)],
+            "pairs": [
+                [len(self.Tquiz[t]) if t == other else self.pairs[t].get(other,0) for other in range(T)]
+                for t in range(T)
+            ],
+            "conflicts": conflicts.tolist(),
+            "back_to_back": back_to_back.tolist(),
+            "hat_tricks": hat_tricks.tolist(),
+            "cross_division": cross_division.tolist(),
+            "energy": self.E
+        }
+
+        # The counts of the optional terms which the energy spec switched on
+        terms = [
+            (i, name) for i, (name, compiled) in enumerate([
+                ("preferred_room", self.room_cost),
+                ("unavailable", self.slot_cost),
+                ("sibling_conflict", self.siblings),
+                ("early_slots", self.early_cap),
+                ("late_slots", self.late_cap)
+            ], 6) if compiled is not None
+        ]
+        if terms:
+            events = [self.get_team_events(t) for t in range(T)]
+            for i, name in terms:
+                metrics[name] = [e[i] for e in events]
+        return metrics
+
     def get_stats(self,verbose=False):
         """Generate statistics on the draw
         """
         stats = {}
+        metrics = self.get_metrics()
 
-        for char in self.Tlist:
+        for t in range(self.T):
             stat = {}
 
-            # Get the number of times `char` will quiz in each room
-            for ri in range(self.R):
-                stat[ri] = 0
-            for si,ri in self.Tquiz[char]:
-                stat[ri] += 1
+            # Get the number of times `t` will quiz in each room
+            stat['rooms'] = metrics['rooms'][t]
 
-            # Get the number of times `char` will quiz each other tea
-            for other_char in self.Tlist:
-                stat[other_char] = 0
-                for si,ri in self.Tquiz[char]:
-                    stat[other_char] += int(other_char in self.draw[si][ri].s)
+            # Get the number of times `t` will quiz each other team
+            stat['teams'] = metrics['pairs'][t]
 
             # Check for coincident quizzing and back-to-back quizzes
             stat['cq'] = [False,[]]
             stat['btb'] = [0,[]]
+            # The back-to-backs, grouped by their first slot
+            btb_from = {}
             for i in range(self.qpt-1):
-                si1,ri1 = self.Tquiz[char][i]
+                si1,ri1 = self.Tquiz[t][i]
                 for j in range(i+1,self.qpt):
-                    si2,ri2 = self.Tquiz[char][j]
+                    si2,ri2 = self.Tquiz[t][j]
                     if si1 == si2 and ri1 == ri2:
                         stat['cq'][0] = True
                         stat['cq'][1].append((si1,ri1,si2,ri2))
                     if ((si1 == si2 + 1) or (si1 == si2 - 1)) and si2 != self.breakindex:
                         stat['btb'][0] += 1
                         stat['btb'][1].append((si1,ri1,si2,ri2))
+                        si = min(si1,si2)
+                        btb_from[si] = btb_from.get(si,0) + 1
 
-            # Check for hat tricks
+            # Check for hat tricks: a back-to-back followed by another
+            #  back-to-back starting one slot later
             stat['ht'] = [0,[]]
-            l = len(stat['btb'][1])
-            for i in range(max(0,l-1)):
-                for j in range(i+1,l):
-                    si1,ri1,si2,ri2 = stat['btb'][1][i]
-                    si3,ri3,si4,ri4 = stat['btb'][1][j]
-                    if max(si1,si2,si3,si4) == min(si1,si2,si3,si4) + 2:
-                        stat['ht'][0] += 1
-                        stat['ht'][1].append((
-                            min(si1,si2,si3,si4),
-                            int(0.5*((si1+si2+si3+si4)-max(si1,si2,si3,si4)-min(si1,si2,si3,si4))),
-                            max(si1,si2,si3,si4)
-                        ))
-
-
-            stats[char] = stat
+            for si in sorted(btb_from):
+                for _ in range(btb_from[si]*btb_from.get(si+1,0)):
+                    stat['ht'][0] += 1
+                    stat['ht'][1].append((si,si+1,si+2))
+
+            stats[t] = stat
 
         if verbose:
             # Quizzes are valid if no team is schedule to quiz in two places at
@@ -468,16 +1668,19 @@ class Prelims:
             for k,v in {k:v['btb'][1] for k,v in stats.items() if v['btb'][0] > 0}.items():
                 print("\t",k,":",len(v))
 
+            # Width of the team id columns
+            w = len(str(self.T-1))
+
             print("Room Assignments:")
-            print("\t  "," ".join([str(i+1) for i in range(self.R)]))
-            for char in self.Tlist:
-                print("\t",char," ".join([str(stats[char][i]) for i in range(self.R)]))
+            print("\t"+w*" "," ".join([str(i+1) for i in range(self.R)]))
+            for t in range(self.T):
+                print("\t"+str(t).rjust(w)," ".join([str(n) for n in stats[t]['rooms']]))
 
 
             print("Team Corelation:")
-            print("   "," ".join(self.Tlist))
-            for char in self.Tlist:
-                print(char+" |"," ".join([str(stats[char][other_char]) for other_char in self.Tlist]))
+            print(w*" "+"  "," ".join([str(t).rjust(w) for t in range(self.T)]))
+            for t in range(self.T):
+                print(str(t).rjust(w)+" |"," ".join([str(n).rjust(w) for n in stats[t]['teams']]))
 
 
             print("Final Energy:")
@@ -497,14 +1700,14 @@ class Prelims:
     def to_text(self,swaplist = None):
         """Render the draw to a nice text form
 
-        Teams are comma delimited, quizzes are semi-colon delimited, and slots
-        are cariage-return delimited
+        Teams are comma delimited integer ids, empty seats are marked by "_",
+        quizzes are semi-colon delimited, and slots are cariage-return delimited
         """
         l = [
             ";".join([
-                ",".join([
-                    char for char in str(q)[str(q).index("<")+1:str(q).index(">")]
-                ]) for q in s ]) for s in self.draw
+                ",".join(
+                    [str(t) for t in self.teams_in(si,ri)] + (3-len(q))*["_"]
+                ) for ri,q in enumerate(s) ]) for si,s in enumerate(self.draw)
         ]
         l.insert(self.breakindex,"")
         return "\n".join(l)
@@ -512,6 +1715,9 @@ class Prelims:
     @classmethod
     def from_text(cls,file_path):
         """Reconstruct a draw from a file genereated by `.to_text()`
+
+        Older files, which labeled teams by letters rather than by integer ids,
+        are also accepted.
         """
         with open(file_path) as f:
             draw = []
@@ -527,7 +1733,7 @@ class Prelims:
         swaplist = [char for char in set(team) if char != '' and char != '_']
 
         nTeams = len(swaplist)
-        QpT = len([char for char in team if char == 'A'])
+        QpT = len([char for char in team if char != '' and char != '_'])//nTeams
         breakless = [s for s in draw if s != [['']]]
         nRooms = len(breakless[0])
         try:
@@ -539,9 +1745,11 @@ class Prelims:
 
         for si,s in enumerate(breakless):
             for ri,q in enumerate(s):
-                if q != ['_','_','_']:
-                    for char in q:
-                        new_cls.push(char,si,ri)
+                for char in q:
+                    if char.isdigit():
+                        new_cls.push(int(char),si,ri)
+                    elif char != '_':
+                        new_cls.push(LEGACY_TEAM_ALPHABET.index(char),si,ri)
 
         new_cls.E = new_cls.get_total_energy()
 
@@ -565,38 +1773,99 @@ class Prelims:
                 team1: "",     # Team name
                 team2: "",     # Team name
                 team3: "",     # Team name
-                type: "P"      # Prelim type quiz
+                type: "P",     # Prelim type quiz
+                seed: "123"    # Seed of the draw, see `Prelims(...)`
             },
             ...
         ]
         """
-        swaplist = {char:team for char,team in zip(self.Tlist,team_list)}
-        swaplist[""] = ""
         quizzes = []
         qi = 0
         for si, s in enumerate(self.draw):
             for ri, q in enumerate(s):
-                if not q.empty:
+                teams = self.teams_in(si,ri)
+                if len(teams):
                     qi += 1
                     quiz = {
                         "quiz_num": str(qi),
                         "slot_num": str(si+1),
                         "room_num": str(ri+1),
-                        "type": "P"
+                        "type": "P",
+                        "seed": str(self.seed)
                     }
                     for i in range(3):
-                        quiz["team{}".format(i+1)] = swaplist[q.s[i]]
+                        quiz["team{}".format(i+1)] = team_list[teams[i]]
                     quizzes.append(quiz)
 
         return quizzes
 
 
+def _kT_list(schedule):
+    # The temperature of each step of a ._metropolis(...) run, from one of:
+    #  ("constant", N, kT), ("log", N, kTmax, kTmin) or ("linear", N, kTmax, kTmin)
+    kind, N = schedule[:2]
+    if kind == "constant":
+        return [schedule[2]]*N
+    kTmax, kTmin = schedule[2:]
+    if kind == "log":
+        lkTmax,lkTmin = log10(kTmax), log10(kTmin)
+        step = (lkTmin-lkTmax)/N
+        return [10.0**(lkTmax + step*i) for i in range(N)]
+    step = (kTmin-kTmax)/N
+    return [kTmax + step*i for i in range(N)]
+
+
+# The jobs of the worker processes of Prelims.multistart(...), .scenarios(...)
+#  and .temper(...), which live at the module level so that they can be sent
+#  to the workers
+
+def _anneal_chain(job):
+    # Initialize and anneal a single draw for `Prelims.multistart(...)`
+    cls, args, N, kwargs, seed = job
+    prelim = cls(*args)
+    prelim.seed = seed
+    prelim.rng.seed(seed)
+    return prelim.initialize().anneal(N, **kwargs)
+
+
+def _evaluate_scenario(job):
+    # Draw a single scenario for `Prelims.scenarios(...)`
+    cls, nTeams, scenario, N, seed, minutes_per_quiz, kwargs = job
+    result = dict(scenario, energy = None, slots = None, slots_before_break = None, makespan = None,
+        conflicts = None, back_to_back = None, hat_tricks = None, error = None)
+    try:
+        prelim = cls(nTeams, scenario['QpT'], scenario['nRooms'], scenario['breakloc'],
+            scenario['numblanks'], seed, **kwargs)
+        prelim.initialize().anneal(N)
+    except (AssertionError, ValueError) as e:
+        result['error'] = str(e) or e.__class__.__name__
+        return result
+    metrics = prelim.get_metrics()
+    result.update(
+        energy = prelim.E,
+        slots = prelim.S,
+        slots_before_break = min(prelim.breakindex, prelim.S),
+        makespan = prelim.S*minutes_per_quiz,
+        conflicts = sum(metrics['conflicts']),
+        back_to_back = sum(metrics['back_to_back']),
+        hat_tricks = sum(metrics['hat_tricks'])
+    )
+    return result
+
+
+def _thermalize_replica(job):
+    # Thermalize a single replica for `Prelims.temper(...)`
+    prelim, N, kT, alpha, seed = job
+    prelim.rng.seed(seed)
+    return prelim.thermalize(N, kT = kT, alpha = alpha)
+
+
 class RoundRobin(Prelims):
-    def __init__(self, nTeams, QpT = 3):#, nSlots, extraSlots):
+    def __init__(self, nTeams, QpT = 3, seed = None):#, nSlots, extraSlots):
         nRooms = 1
 
         # numblanks = (nRooms * nSlots) - (nTeams * QpT // 3 - extraSlots)
-        Prelims.__init__(self, nTeams, QpT, nRooms)#, numblanks = numblanks)
+        Prelims.__init__(self, nTeams, QpT, nRooms, seed = seed)#, numblanks = numblanks)
 
     def generate_json(self, room_num, offset_bracket, offset_slot):
         """Generate the json representation
@@ -613,14 +1882,13 @@ class RoundRobin(Prelims):
         offset_slot : int
             The slot number of the last prelim.
         """
-        team_list = ["P_{}".format(9*offset_bracket+1+i) for i in range(len(self.Tlist))]
-        swaplist = {char:team for char,team in zip(self.Tlist,team_list)}
-        swaplist[""] = ""
+        team_list = ["P_{}".format(9*offset_bracket+1+i) for i in range(self.T)]
         quizzes = []
         qi = 0
         for si, s in enumerate(self.draw):
             for ri, q in enumerate(s):
-                if not q.empty:
+                teams = self.teams_in(si,ri)
+                if len(teams):
                     qi += 1
                     quiz = {
                         "quiz_num": "ABCDEFGHIJKLMNOPQRSTUVWXYZ"[qi-1] + str(offset_bracket),
@@ -629,7 +1897,7 @@ class RoundRobin(Prelims):
                         "type": "ABC"[offset_bracket-1]
                     }
                     for i in range(3):
-                        quiz["team{}".format(i+1)] = swaplist[q.s[i]]
+                        quiz["team{}".format(i+1)] = team_list[teams[i]]
                     quizzes.append(quiz)
 
         return quizzes
@@ -812,7 +2080,7 @@ def generate_bracket_json(bracket_style, slot_offset, num_brackets = 1, finals_r
                         quizzes.append(quiz)
     return quizzes
 
-def generate_semis_json(nTeams, slot_offset, finals_repeats = [1,1,1], bracket_style = 'condensed'):
+def generate_semis_json(nTeams, slot_offset, finals_repeats = [1,1,1], bracket_style = 'condensed', seed = None):
     quizzes = generate_bracket_json(
         bracket_style = bracket_style,
         slot_offset = slot_offset,
@@ -826,7 +2094,8 @@ def generate_semis_json(nTeams, slot_offset, finals_repeats = [1,1,1], bracket_s
     if NT >= 3:
         quizzes += RoundRobin(
             nTeams = NT,
-            QpT = QpT
+            QpT = QpT,
+            seed = seed
         ).initialize().anneal(1000).generate_json(
             room_num,
             offset_bracket = nTeams//9,
@@ -0,0 +1,323 @@
+# The annealing kernel for `Prelims`, which runs the same moves and energy
+#  model as the pure Python `Prelims._thermalization_step(...)` over flat
+#  arrays. If numba is installed, the kernel is JIT compiled, otherwise these
+#  are plain Python functions (which are correct, but slower than `Prelims`).
+#
+# The kernel supports the core energy terms and divisions, but not the
+#  optional terms of an energy spec (see `Prelims.compile_energy(...)`).
+
+from array import array
+from math import exp
+
+try:
+    from numba import config, njit
+    import numpy
+    HAVE_NUMBA = True
+    # NUMBA_DISABLE_JIT=1 leaves the functions as plain Python
+    COMPILED = not config.DISABLE_JIT
+except ImportError:
+    HAVE_NUMBA = COMPILED = False
+
+    def njit(*args, **kwargs):
+        # Leave the functions as they are
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+def buffers(*arrays):
+    """The arguments of run(...) which numba can compile against
+
+    Compiled code can't slice or copy `array.array`s, so they are replaced by
+    numpy views of the same memory (the kernel still updates the arrays in
+    place). Anything else, and everything if the kernel isn't compiled, is
+    left as it is.
+    """
+    if not COMPILED:
+        return arrays
+    return tuple(
+        numpy.frombuffer(a, a.typecode) if isinstance(a, array) else a
+        for a in arrays
+    )
+
+
+# The mask of the 48 bit linear congruential generator used by the kernel. It
+#  gives the same numbers compiled or not, since it only needs the low 48 bits
+#  of (wrapping) 64 bit integer arithmetic
+_MASK = (1 << 48) - 1
+
+
+@njit(cache = True)
+def _next(rng, bits):
+    rng[0] = (rng[0]*0x5DEECE66D + 0xB) & _MASK
+    return rng[0] >> (48 - bits)
+
+
+@njit(cache = True)
+def _random(rng):
+    # A uniform random float in [0, 1)
+    return ((_next(rng, 26) << 27) + _next(rng, 27)) * (1.0 / 9007199254740992.0)
+
+
+@njit(cache = True)
+def _randint(rng, a, b):
+    # A uniform random integer in [a, b]
+    return a + int(_random(rng)*(b - a + 1))
+
+
+@njit(cache = True)
+def _count(seats, counts, qi, t):
+    # The number of times team `t` is in quiz `qi`
+    n = 0
+    for j in range(3*qi, 3*qi + counts[qi]):
+        n += seats[j] == t
+    return n
+
+
+@njit(cache = True)
+def _pop(seats, counts, occupancy, pairs, T, R, t, qi):
+    # Remove team `t` from quiz `qi`, see `Prelims._pop(...)`
+    o, n = 3*qi, counts[qi]
+    i = o
+    while seats[i] != t:
+        i += 1
+    for j in range(i, o + n - 1):
+        seats[j] = seats[j + 1]
+    seats[o + n - 1] = -1
+    counts[qi] = n - 1
+    occupancy[(qi // R)*T + t] -= 1
+    for j in range(o, o + n - 1):
+        other = seats[j]
+        if other != t:
+            pairs[t*T + other] -= 1
+            pairs[other*T + t] -= 1
+
+
+@njit(cache = True)
+def _push(seats, counts, occupancy, pairs, T, R, t, qi):
+    # Add team `t` to quiz `qi`, see `Prelims._push(...)`
+    o, n = 3*qi, counts[qi]
+    for j in range(o, o + n):
+        other = seats[j]
+        if other != t:
+            pairs[t*T + other] += 1
+            pairs[other*T + t] += 1
+    seats[o + n] = t
+    counts[qi] = n + 1
+    occupancy[(qi // R)*T + t] += 1
+
+
+@njit(cache = True)
+def _move(tq, QpT, t, qi_old, qi_new):
+    # Update the index of the quizzes of team `t`
+    k = t*QpT
+    while tq[k] != qi_old:
+        k += 1
+    tq[k] = qi_new
+
+
+@njit(cache = True)
+def _team_events(seats, counts, occupancy, pairs, tq, divisions, room_ok, T, R, S, QpT, breakindex, multidivision, t):
+    # The event counts of team `t`, see `Prelims.get_team_events(...)`
+    cq = quizzed = btb = ht = seen = cross = 0
+    d = divisions[t]
+    for k in range(t*QpT, (t+1)*QpT):
+        qi = tq[k]
+        si, ri = qi // R, qi % R
+
+        cq += occupancy[si*T + t] > 1
+
+        for k2 in range(t*QpT, (t+1)*QpT):
+            quizzed += tq[k2] % R == ri
+        quizzed -= 1
+
+        if si != breakindex:
+            _si = (si - 1) % S
+            if occupancy[_si*T + t] - (_si == si) > 0:
+                btb += 1
+                if si - 2 >= -S:
+                    _si = (si - 2) % S
+                    ht += occupancy[_si*T + t] - (_si == si) > 0
+
+        for j in range(3*qi, 3*qi + counts[qi]):
+            other = seats[j]
+            if other != t:
+                seen += pairs[t*T + other] - _count(seats, counts, qi, other)
+            if multidivision:
+                cross += divisions[other] != d
+        if multidivision:
+            cross += room_ok[d*R + ri] == 0
+    return cq, quizzed, btb, ht, seen, cross
+
+
+@njit(cache = True)
+def _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, nteams, hot_flags):
+    # The weighted sum of the events of the teams in `teams[:nteams]`, saving
+    #  whether each one is "hot" into `hot_flags`
+    E = 0.0
+    for i in range(nteams):
+        cq, quizzed, btb, ht, seen, cross = _team_events(
+            seats, counts, occupancy, pairs, tq, divisions, room_ok, T, R, S, QpT, breakindex, multidivision, teams[i]
+        )
+        E += weights[0]*cq + weights[1]*quizzed + weights[2]*btb + weights[3]*ht + weights[4]*seen + weights[5]*cross
+        hot_flags[i] = cq > 0 or ht > 0 or cross > 0
+    return E
+
+
+@njit(cache = True)
+def _gather(seats, counts, qi1, qi2, teams):
+    # Collect the distinct teams of two quizzes into `teams`
+    n = 0
+    for qi in (qi1, qi2):
+        for j in range(3*qi, 3*qi + counts[qi]):
+            t = seats[j]
+            new = True
+            for i in range(n):
+                if teams[i] == t:
+                    new = False
+            if new:
+                teams[n] = t
+                n += 1
+    return n
+
+
+@njit(cache = True)
+def _set_hot(hot, hot_index, nhot, t, is_hot):
+    # Add or remove `t` from the hot teams, see `Prelims._update_hot(...)`
+    if is_hot and hot_index[t] < 0:
+        hot_index[t] = nhot
+        hot[nhot] = t
+        nhot += 1
+    elif not is_hot and hot_index[t] >= 0:
+        i = hot_index[t]
+        nhot -= 1
+        last = hot[nhot]
+        hot_index[t] = -1
+        if last != t:
+            hot[i] = last
+            hot_index[last] = i
+    return nhot
+
+
+@njit(cache = True)
+def run(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, hot, hot_index, teams, hot_flags, moved,
+        rng, best_seats, best_counts, T, R, S, QpT, nQuizzes, breakindex, multidivision, nhot, kT_list, alpha,
+        hot_bias, E, best, since_best, target_energy, patience, patience_kT, keep_best):
+    """Run the Metropolis Algorithm through `kT_list`
+
+    Returns the energy, the number of accepted interchanges, the number of
+    steps run, the best energy, the number of steps since the best energy
+    (only counting steps at or below `patience_kT`), a stop code (0 = ran
+    every step, 1 = target_energy, 2 = patience) and the number of hot teams
+    in `hot`. Pass -1 as the patience to turn it off, and -1 as `nhot` to find
+    the hot teams from scratch. If `keep_best`, the lowest energy draw is
+    copied into `best_seats` and `best_counts`. `teams`, `hot_flags` and
+    `moved` are scratch space for 6 teams each.
+    """
+    if nhot < 0:
+        # Find the hot teams from scratch
+        nhot = 0
+        for t in range(T):
+            hot_index[t] = -1
+        for t in range(T):
+            teams[0] = t
+            _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, 1, hot_flags)
+            nhot = _set_hot(hot, hot_index, nhot, t, hot_flags[0])
+
+    accepted = 0
+    steps = 0
+    stop = 0
+    for kT in kT_list:
+        target = -1
+        if nhot > 0 and _random(rng) < hot_bias:
+            target = hot[_randint(rng, 0, nhot - 1)]
+
+        if _random(rng) > alpha:
+            # Try a team interchange
+            t1, t2 = _randint(rng, 0, T - 1), _randint(rng, 1, T - 1)
+            if target >= 0:
+                t1 = target
+            t2 = (t1 + t2) % T
+            qi1 = tq[t1*QpT + _randint(rng, 0, QpT - 1)]
+            qi2 = tq[t2*QpT + _randint(rng, 0, QpT - 1)]
+            nteams = _gather(seats, counts, qi1, qi2, teams)
+            E_old = _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, nteams, hot_flags)
+            _pop(seats, counts, occupancy, pairs, T, R, t1, qi1)
+            _pop(seats, counts, occupancy, pairs, T, R, t2, qi2)
+            _push(seats, counts, occupancy, pairs, T, R, t2, qi1)
+            _push(seats, counts, occupancy, pairs, T, R, t1, qi2)
+            _move(tq, QpT, t1, qi1, qi2)
+            _move(tq, QpT, t2, qi2, qi1)
+            deltaE = _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, nteams, hot_flags) - E_old
+            accept = deltaE < 0 or (kT > 0 and _random(rng) < exp(-deltaE/kT))
+            if not accept:
+                _pop(seats, counts, occupancy, pairs, T, R, t2, qi1)
+                _pop(seats, counts, occupancy, pairs, T, R, t1, qi2)
+                _push(seats, counts, occupancy, pairs, T, R, t1, qi1)
+                _push(seats, counts, occupancy, pairs, T, R, t2, qi2)
+                _move(tq, QpT, t1, qi2, qi1)
+                _move(tq, QpT, t2, qi1, qi2)
+        else:
+            # Try a quiz interchange
+            qi1, qi2 = _randint(rng, 0, nQuizzes - 1), _randint(rng, 0, nQuizzes - 1)
+            if target >= 0:
+                qi1 = tq[target*QpT + _randint(rng, 0, QpT - 1)]
+            nteams = _gather(seats, counts, qi1, qi2, teams)
+            E_old = _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, nteams, hot_flags)
+            n1 = counts[qi1]
+            for j in range(n1):
+                moved[j] = seats[3*qi1]
+                _pop(seats, counts, occupancy, pairs, T, R, moved[j], qi1)
+            n2 = counts[qi2]
+            for j in range(n2):
+                moved[3 + j] = seats[3*qi2]
+                _pop(seats, counts, occupancy, pairs, T, R, moved[3 + j], qi2)
+            for j in range(n1):
+                _push(seats, counts, occupancy, pairs, T, R, moved[j], qi2)
+                _move(tq, QpT, moved[j], qi1, -1)
+            for j in range(n2):
+                _push(seats, counts, occupancy, pairs, T, R, moved[3 + j], qi1)
+                _move(tq, QpT, moved[3 + j], qi2, qi1)
+            for j in range(n1):
+                _move(tq, QpT, moved[j], -1, qi2)
+            deltaE = _local_energy(seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision, teams, nteams, hot_flags) - E_old
+            accept = deltaE < 0 or (kT > 0 and _random(rng) < exp(-deltaE/kT))
+            if not accept:
+                for j in range(n1):
+                    _pop(seats, counts, occupancy, pairs, T, R, moved[j], qi2)
+                    _move(tq, QpT, moved[j], qi2, -1)
+                for j in range(n2):
+                    _pop(seats, counts, occupancy, pairs, T, R, moved[3 + j], qi1)
+                for j in range(n1):
+                    _push(seats, counts, occupancy, pairs, T, R, moved[j], qi1)
+                for j in range(n2):
+                    _push(seats, counts, occupancy, pairs, T, R, moved[3 + j], qi2)
+                    _move(tq, QpT, moved[3 + j], qi1, qi2)
+                for j in range(n1):
+                    _move(tq, QpT, moved[j], -1, qi1)
+
+        if accept:
+            E += deltaE
+            accepted += 1
+            for i in range(nteams):
+                nhot = _set_hot(hot, hot_index, nhot, teams[i], hot_flags[i])
+        steps += 1
+
+        # Check the early stopping criteria
+        if E < best - 1e-9:
+            best, since_best = E, 0
+            if keep_best:
+                for j in range(len(seats)):
+                    best_seats[j] = seats[j]
+                for j in range(len(counts)):
+                    best_counts[j] = counts[j]
+        elif kT <= patience_kT:
+            since_best += 1
+        if E <= target_energy:
+            stop = 1
+            break
+        if patience >= 0 and since_best >= patience:
+            stop = 2
+            break
+
+    return E, accepted, steps, best, since_best, stop, nhot
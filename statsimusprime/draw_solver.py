@@ -0,0 +1,194 @@
+# An exact solver for small `Prelims` draws, which writes the draw as a
+#  constraint program for the CP-SAT solver of Google's OR-Tools
+#  (`pip install ortools`). The objective is the same energy as `Prelims`,
+#  except that a team quizzing in two places at once, or against (or in the
+#  rooms of) another division, are made impossible rather than penalized.
+#
+# See `Prelims.solve(...)`, which starts the solver from an annealed draw and
+#  only keeps the solver's draw if it is better, and falls back to annealing
+#  when OR-Tools isn't installed.
+
+try:
+    from ortools.sat.python import cp_model
+    HAVE_ORTOOLS = True
+except ImportError:
+    HAVE_ORTOOLS = False
+
+# The energy weights are scaled by this and rounded to give the integer
+#  objective coefficients which CP-SAT needs
+SCALE = 1000
+
+
+def _and(model, a, b):
+    # A boolean variable which is exactly `a and b`
+    z = model.NewBoolVar("")
+    model.Add(z <= a)
+    model.Add(z <= b)
+    model.Add(z >= a + b - 1)
+    return z
+
+
+def _table(model, n, table):
+    # An integer variable which is exactly `table[n]`
+    v = model.NewIntVar(min(table), max(table), "")
+    model.AddElement(n, table, v)
+    return v
+
+
+def _complete_hint(model):
+    # Every other variable is fixed by the hinted `x`, so solve for them with
+    #  `x` fixed and hint the whole solution. If the draw breaks a constraint
+    #  (e.g. a team quizzing in two places at once), only `x` is hinted
+    solver = cp_model.CpSolver()
+    solver.parameters.fix_variables_to_their_hinted_value = True
+    solver.parameters.max_time_in_seconds = 1.0
+    if not solver.Solve(model) in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return
+    variables = [model.GetIntVarFromProtoIndex(i) for i in range(len(model.Proto().variables))]
+    values = [solver.Value(v) for v in variables]
+    model.ClearHints()
+    for v, value in zip(variables, values):
+        model.AddHint(v, value)
+
+
+def solve(prelim, time_limit = 10.0, workers = None, verbose = False):
+    """Find the lowest energy draw for `prelim` with CP-SAT
+
+    If the draw of `prelim` is already filled in, it is used as a hint (for
+    every variable, not just the seats).
+
+    returns : (status, teams, energy, bound)
+        status is "optimal", "feasible" (the time limit was hit), "infeasible"
+        or "unknown" (no draw was found in time). teams is a list, for each
+        quiz, of the team ids in it (or None if no draw was found), energy is
+        the energy of the draw found, and bound is the lowest energy which any
+        draw could have, proven by the solver.
+    """
+    T, R, S, QpT = prelim.T, prelim.R, prelim.S, prelim.qpt
+    nQuizzes = prelim.Q + prelim.B
+    w = dict(zip(prelim.energy_terms, [int(round(SCALE*x)) for x in prelim.energy_weights]))
+    model = cp_model.CpModel()
+    objective = []
+
+    # x[t][qi] : team `t` is in quiz `qi`
+    x = [[model.NewBoolVar("x{}_{}".format(t, qi)) for qi in range(nQuizzes)] for t in range(T)]
+
+    # Quizzes are either full or blank, and every team has QpT quizzes
+    full = [model.NewBoolVar("full{}".format(qi)) for qi in range(nQuizzes)]
+    for qi in range(nQuizzes):
+        model.Add(sum(x[t][qi] for t in range(T)) == 3*full[qi])
+    model.Add(sum(full) == prelim.Q)
+    for t in range(T):
+        model.Add(sum(x[t]) == QpT)
+
+    # y[t][si] : team `t` is quizzing in slot `si`, which can only be once
+    slots = [[qi for qi in range(nQuizzes) if qi // R == si] for si in range(S)]
+    y = [[model.NewBoolVar("") for si in range(S)] for t in range(T)]
+    for t in range(T):
+        for si in range(S):
+            model.Add(y[t][si] == sum(x[t][qi] for qi in slots[si]))
+
+    # Divisions only use their rooms, and only quiz themselves
+    for t in range(T):
+        d = prelim.divisions[t]
+        for qi in range(nQuizzes):
+            if not prelim.room_ok[d][qi % R]:
+                model.Add(x[t][qi] == 0)
+
+    for t in range(T):
+        # Quizzing in the same room, counted the same way as
+        #  `Prelims.get_team_events(...)`
+        for ri in range(R):
+            n = model.NewIntVar(0, QpT, "")
+            model.Add(n == sum(x[t][qi] for qi in range(nQuizzes) if qi % R == ri))
+            objective.append(w['already_quizzed']*_table(model, n, [k*(k-1) for k in range(QpT+1)]))
+
+        # Back-to-backs and hat tricks, which (like the energy) look back
+        #  from the first slot to the last ones
+        for si in range(S):
+            if si == prelim.breakindex:
+                continue
+            s1 = (si-1) % S
+            if s1 == si:
+                continue
+            btb = _and(model, y[t][si], y[t][s1])
+            objective.append(w['back_to_back']*btb)
+            s2 = (si-2) % S
+            if si-2 >= -S and s2 != si:
+                objective.append(w['hat_trick']*_and(model, btb, y[t][s2]))
+
+    # The number of times each pair of teams meet
+    meets = {}
+    for t in range(T):
+        for other in range(t+1, T):
+            if prelim.divisions[t] != prelim.divisions[other]:
+                for qi in range(nQuizzes):
+                    model.Add(x[t][qi] + x[other][qi] <= 1)
+                continue
+            n = model.NewIntVar(0, QpT, "")
+            model.Add(n == sum(_and(model, x[t][qi], x[other][qi]) for qi in range(nQuizzes)))
+            meets[t, other] = n
+            # Counted once by each team
+            objective.append(2*w['already_seen']*_table(model, n, [k*(k-1) for k in range(QpT+1)]))
+
+    # The optional terms of the energy spec
+    if prelim.room_cost is not None:
+        objective.append(w['preferred_room']*sum(
+            prelim.room_cost[t*R+qi % R]*x[t][qi] for t in range(T) for qi in range(nQuizzes)
+        ))
+    if prelim.slot_cost is not None:
+        objective.append(w['unavailable']*sum(
+            prelim.slot_cost[t*S+qi // R]*x[t][qi] for t in range(T) for qi in range(nQuizzes)
+        ))
+    if prelim.siblings is not None:
+        conflicts = {}
+        for t in range(T):
+            for other in prelim.siblings[t]:
+                # Quizzing at the same time, but not in the same quiz. This is
+                #  its own (non-negative) variable, so that the bound isn't
+                #  pulled below zero by subtracting the meets
+                pair = (min(t, other), max(t, other))
+                if not pair in conflicts:
+                    conflicts[pair] = model.NewIntVar(0, S, "")
+                    model.Add(conflicts[pair] == sum(_and(model, y[t][si], y[other][si]) for si in range(S)) - meets.get(pair, 0))
+                objective.append(w['sibling_conflict']*conflicts[pair])
+    for cap, name in ((prelim.early_cap, 'early_slots'), (prelim.late_cap, 'late_slots')):
+        if cap is None:
+            continue
+        n, k = cap
+        for t in range(T):
+            count = model.NewIntVar(0, QpT, "")
+            if name == 'early_slots':
+                model.Add(count == sum(x[t][qi] for qi in range(nQuizzes) if qi // R < n))
+            else:
+                model.Add(count == sum(x[t][qi] for qi in range(nQuizzes) if qi // R >= S-n))
+            objective.append(w[name]*_table(model, count, [c if c > k else 0 for c in range(QpT+1)]))
+
+    model.Minimize(sum(objective))
+
+    # Start from the current draw, if there is one
+    solver = cp_model.CpSolver()
+    if sum(prelim.counts) > 0:
+        for qi in range(nQuizzes):
+            teams = prelim.teams_in(*divmod(qi, R))
+            for t in range(T):
+                model.AddHint(x[t][qi], t in teams)
+        _complete_hint(model)
+        # Otherwise presolve (e.g. symmetry breaking) can rule out the hint
+        solver.parameters.keep_all_feasible_solutions_in_presolve = True
+
+    solver.parameters.max_time_in_seconds = time_limit
+    if workers is not None:
+        solver.parameters.num_search_workers = workers
+    solver.parameters.log_search_progress = verbose
+    status = solver.Solve(model)
+
+    status = {
+        cp_model.OPTIMAL: "optimal",
+        cp_model.FEASIBLE: "feasible",
+        cp_model.INFEASIBLE: "infeasible"
+    }.get(status, "unknown")
+    if not status in ("optimal", "feasible"):
+        return status, None, None, None
+    teams = [[t for t in range(T) if solver.Value(x[t][qi])] for qi in range(nQuizzes)]
+    return status, teams, solver.ObjectiveValue()/SCALE, solver.BestObjectiveBound()/SCALE
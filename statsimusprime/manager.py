@@ -3,7 +3,9 @@
 import pickle
 import os
 import json
+import threading
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 from urllib.parse import urlparse
@@ -15,6 +17,7 @@ from apiclient.http import MediaFileUpload
 
 # from statsimusprime.service import DriveService, StatsService, ScoresheetService
 
+from statsimusprime.service.baseservice import RateLimiter, with_backoff
 from statsimusprime.service.driveservice import DriveService
 from statsimusprime.service.statsservice import StatsService
 from statsimusprime.service.scoresheetservice import ScoresheetService
@@ -54,7 +57,15 @@ class Manager:
             with open(tokenfp, 'wb') as token:
                 pickle.dump(creds, token)
 
-        self.drive_service = DriveService(build('drive', 'v3', credentials=creds))
+        # Kept to build a separate client for each worker thread, since the
+        #  google clients aren't thread safe
+        self.creds = creds
+        self.drive_service = DriveService(
+            build('drive', 'v3', credentials=creds),
+            client_factory = lambda: build('drive', 'v3', credentials=creds),
+            cache_ttl = 600,
+            cache_path = os.path.join(wd,'.drive_cache.json')
+        )
         ss = build('sheets', 'v4', credentials=creds)
         self.stats_service = StatsService(ss)
         self.ss_service = ScoresheetService(ss)
@@ -336,6 +347,79 @@ class Manager:
                     If None is given, then the correct number of blanks to exactly
                     fill up a prelim draw rectangle will be used.
 
+                num_chains : int : default = 1
+                    The number of independent prelim draws to anneal, each in
+                    its own process. The lowest energy draw is kept.
+
+                num_replicas : int or None : default = None
+                    If given, the prelim draw is optimized by parallel tempering
+                    with this many replicas (see `Prelims.temper`) rather than by
+                    annealing, and num_chains is ignored.
+
+                num_processes : int or None : default = None
+                    The number of processes used when num_chains > 1 or when
+                    num_replicas is given. If None is given, every cpu will be used.
+
+                divisions : list or None : default = None
+                    The divisions sharing the building, which are all drawn
+                    together. Each division is given as:
+                        {
+                            "teams": ["ABC1", "DEF2", ...], # roster team names
+                            "rooms": [1, 2]                 # (optional) 1 indexed
+                        }
+                    Teams only quiz other teams in their own division, and each
+                    division only uses its own rooms, which divisions may share.
+                    If "rooms" is left out, the division can use any room. Any
+                    team not listed is put into one more division, which can
+                    use any room.
+
+                energy : dict or None : default = None
+                    An energy spec for the prelim draw (see
+                    `Prelims.compile_energy`), which changes the penalty weights
+                    and switches on optional constraints. Teams are given by
+                    their roster names, and rooms and slots are 1 indexed:
+                        {
+                            "weights": {"back_to_back": 0.5},
+                            "preferred_rooms": {"teams": {"ABC1": [1, 2]}},
+                            "unavailable": {"weight": 10.0, "teams": {"DEF2": [1, 2, 3]}},
+                            "siblings": {"groups": [["ABC1", "ABC2"]]},
+                            "early_slots": {"slots": 2, "max": 1},
+                            "late_slots": {"slots": 2, "max": 1}
+                        }
+
+                sibling_teams : str, list or None : default = None
+                    Groups of teams which share a coach, so shouldn't quiz at
+                    the same time in different rooms. Off by default. "prefix"
+                    groups together the teams whose names only differ by their
+                    trailing numbers (ABC1, ABC2, ...), or a list of groups of
+                    team names can be given, e.g. [["ABC1", "XYZ"], ...].
+                    Groups given in the energy spec take priority.
+
+                early_stopping : dict : default = {}
+                    Early stopping criteria for annealing the prelims, passed to
+                    `Prelims.anneal` (see `Prelims._metropolis`). For example
+                    {"patience": 2000, "target_metrics": {"conflicts": 0}}
+
+                checkpoint : str or None : default = None
+                    A file path to checkpoint the prelim annealing to (only
+                    used when num_chains = 1 and num_replicas is None). If the
+                    annealing is interrupted, it can be continued with
+                    `Prelims.resume(checkpoint)`.
+
+                solver_time_limit : float or None : default = None
+                    If given, and there are at most 15 teams, the prelims are
+                    annealed and then improved by the exact solver
+                    (`Prelims.solve`, which needs OR-Tools) with this time limit
+                    in seconds. The solver's draw is only used if it is better
+                    than the annealed one.
+
+                seed : int or None : default = None
+                    The seed for the random number generator used to create the
+                    draw. If None is given, one is picked at random. The seed is
+                    recorded in each prelim quiz of `draw.json`, so passing it
+                    back in with the same parameters (and num_chains = 1)
+                    regenerates the same draw.
+
             }
 
         verbose : boolean
@@ -350,6 +434,16 @@ class Manager:
         QpT = draw_params.pop("QpT", 6)
         num_blanks = draw_params.pop("num_blanks", None)
         skip_round_robin = draw_params.pop("skip_round_robin", True)
+        num_chains = draw_params.pop("num_chains", 1)
+        num_replicas = draw_params.pop("num_replicas", None)
+        num_processes = draw_params.pop("num_processes", None)
+        seed = draw_params.pop("seed", None)
+        early_stopping = draw_params.pop("early_stopping", {})
+        division_params = draw_params.pop("divisions", None)
+        energy_params = draw_params.pop("energy", None)
+        sibling_teams = draw_params.pop("sibling_teams", None)
+        checkpoint = draw_params.pop("checkpoint", None)
+        solver_time_limit = draw_params.pop("solver_time_limit", None)
 
         # Document me!
         annealing_steps = draw_params.pop("annealing_steps", 10**4)
@@ -364,17 +458,125 @@ class Manager:
         if len(draw_params.keys()) > 1:
             print("Unused parameters: ",", ".join(draw_params.keys()))
 
-        team_list = list(set([q['team'] for q in self.env['roster']]))
+        # Sorted, so that the same seed always gives the same draw
+        team_list = sorted(set([q['team'] for q in self.env['roster']]))
         nTeams = len(team_list)
 
+        # Find the division of each team, and the rooms of each division
+        divisions, division_rooms = None, None
+        if division_params:
+            divisions = [len(division_params)]*nTeams
+            division_rooms = []
+            for d,division in enumerate(division_params):
+                for team in division['teams']:
+                    divisions[team_list.index(team)] = d
+                rooms = division.get('rooms', None)
+                division_rooms.append(None if rooms is None else [r-1 for r in rooms])
+            division_rooms.append(None)
+            if not len(division_params) in divisions:
+                # Every team is in one of the given divisions
+                division_rooms.pop()
+
+        # Find the groups of teams which share a coach
+        if sibling_teams == "prefix":
+            prefixes = [team.rstrip("0123456789") for team in team_list]
+            sibling_teams = [
+                [team for team, p in zip(team_list, prefixes) if p == prefix]
+                for prefix in sorted(set(prefixes)) if prefix
+            ]
+        sibling_teams = [group for group in (sibling_teams or []) if len(group) > 1]
+
+        # Convert the energy spec to team ids, and 0 indexed rooms and slots
+        energy = None
+        if energy_params or sibling_teams:
+            energy = dict(energy_params or {})
+            if sibling_teams and not "siblings" in energy:
+                energy['siblings'] = {"groups": sibling_teams}
+            for key in ("preferred_rooms", "unavailable"):
+                if key in energy:
+                    energy[key] = dict(energy[key], teams = {
+                        team_list.index(team): [n-1 for n in numbers]
+                        for team, numbers in energy[key]['teams'].items()
+                    })
+            if "siblings" in energy:
+                energy['siblings'] = dict(energy['siblings'], groups = [
+                    [team_list.index(team) for team in group]
+                    for group in energy['siblings']['groups']
+                ])
+
         if verbose:
             print("Generating Prelims, this may take a few minutes . . . ")
-        prelim = Prelims(
-            nTeams = nTeams,
-            QpT = QpT,
-            nRooms = num_rooms,
-            numblanks = num_blanks
-        ).initialize().anneal(annealing_steps, verbose = verbose)
+        if solver_time_limit is not None and nTeams <= 15:
+            prelim = Prelims(
+                nTeams = nTeams,
+                QpT = QpT,
+                nRooms = num_rooms,
+                numblanks = num_blanks,
+                seed = seed,
+                divisions = divisions,
+                division_rooms = division_rooms,
+                energy = energy
+            ).solve(
+                solver_time_limit,
+                fallback_steps = annealing_steps,
+                verbose = verbose
+            )
+            if verbose:
+                print("Solver status:", prelim.solve_status)
+        elif num_replicas:
+            prelim = Prelims(
+                nTeams = nTeams,
+                QpT = QpT,
+                nRooms = num_rooms,
+                numblanks = num_blanks,
+                seed = seed,
+                divisions = divisions,
+                division_rooms = division_rooms,
+                energy = energy
+            ).initialize().temper(
+                annealing_steps,
+                nReplicas = num_replicas,
+                processes = num_processes,
+                verbose = verbose
+            )
+        elif num_chains > 1:
+            prelim, energies = Prelims.multistart(
+                annealing_steps,
+                num_chains,
+                nTeams,
+                QpT,
+                num_rooms,
+                None,
+                num_blanks,
+                None,
+                divisions,
+                division_rooms,
+                energy,
+                processes = num_processes,
+                seed = seed,
+                **early_stopping
+            )
+            if verbose:
+                print("Chain Energies:")
+                for i,E in enumerate(energies):
+                    print("\t",i+1,":","%.3f" % E)
+        else:
+            prelim = Prelims(
+                nTeams = nTeams,
+                QpT = QpT,
+                nRooms = num_rooms,
+                numblanks = num_blanks,
+                seed = seed,
+                divisions = divisions,
+                division_rooms = division_rooms,
+                energy = energy
+            ).initialize().anneal(
+                annealing_steps,
+                kTmax = Prelims.refine_kTmax,
+                verbose = verbose,
+                checkpoint = checkpoint,
+                **early_stopping
+            )
         if verbose:
             prelim.get_stats(verbose=True)
 
@@ -393,7 +595,8 @@ class Manager:
             nTeams = nTeams,
             slot_offset = slot_offset,
             finals_repeats = finals_repeats,
-            bracket_style = bracket_style
+            bracket_style = bracket_style,
+            seed = prelim.seed
         )
 
         if verbose:
@@ -458,6 +661,57 @@ class Manager:
                 print(" | ".join(s))
         return self
 
+    def compare_draw_scenarios(self, grid, draw_params = {}, verbose = True):
+        """Compare prelim draws for several room and QpT layouts of the meet
+
+        Each scenario is drawn in parallel for the teams in self.env['roster']
+        (see `Prelims.scenarios`). Nothing is written to disk or the cloud.
+
+        grid : dict or list
+            Either a dictionary of lists of values to try for each of "nRooms",
+            "QpT", "numblanks" and "breakloc" (every combination is drawn), or
+            a list of dictionaries, one for each scenario.
+            e.g. {"nRooms": [4, 5], "QpT": [6, 9]}
+
+        draw_params : obj = {
+                annealing_steps : int : default = 10**4
+                num_processes : int or None : default = None
+                seed : int or None : default = None
+                minutes_per_quiz : int : default = 20
+            }
+            See `.generate_draw_from_roster`
+
+        verbose : boolean
+            If verbose, prints a table of the scenarios
+
+        returns : list
+            The results of `Prelims.scenarios`, one for each scenario
+        """
+        team_list = sorted(set([q['team'] for q in self.env['roster']]))
+        results = Prelims.scenarios(
+            len(team_list),
+            grid,
+            N = draw_params.get("annealing_steps", 10**4),
+            processes = draw_params.get("num_processes", None),
+            seed = draw_params.get("seed", None),
+            minutes_per_quiz = draw_params.get("minutes_per_quiz", 20)
+        )
+        if verbose:
+            print("{: >5} {: >4} {: >6} {: >5} {: >8} {: >5} {: >8} {: >4} {: >4} {: >4}".format(
+                "rooms", "QpT", "blanks", "break", "energy", "slots", "minutes", "CQ", "BTB", "HT"
+            ))
+            for r in results:
+                if r['error']:
+                    print("{: >5} {: >4} {: >6} {: >5}  {}".format(
+                        r['nRooms'], r['QpT'], str(r['numblanks']), str(r['breakloc']), r['error']
+                    ))
+                    continue
+                print("{: >5} {: >4} {: >6} {: >5} {: >8.2f} {: >5} {: >8} {: >4} {: >4} {: >4}".format(
+                    r['nRooms'], r['QpT'], str(r['numblanks']), str(r['breakloc']), r['energy'],
+                    r['slots'], r['makespan'], r['conflicts'], r['back_to_back'], r['hat_tricks']
+                ))
+        return results
+
     def load_draw(self, file_path):
         """Loads a draw json file into the manager env object
 
@@ -532,66 +786,133 @@ class Manager:
             )
 
         print("Copying Scoresheets")
-        for ss in self.drive_service.get_all_children(self.env['scoresheets_id']):
-            if ss['mimeType'] == 'application/vnd.google-apps.spreadsheet':
-                print("Copying",ss['name'])
-
-                # Create a backup
-                bu_ss_id = self.drive_service.copy_to(
-                    file_id = ss['id'],
-                    name = ss['name'],
-                    destination_folder_id = bu_id
-                ).get("id")
-
-                # Override all formulas to static values
-                for data in self.ss_service.generate_all_values(ss['id']):
-                    self.ss_service.update_values(
-                        file_id = bu_ss_id,
-                        range = data['range'],
-                        values = data['values']
-                    )
+        scoresheets = [
+            ss for ss in self.drive_service.get_all_children(self.env['scoresheets_id'])
+            if ss['mimeType'] == 'application/vnd.google-apps.spreadsheet'
+        ]
+        # Create the backups with batch requests
+        copies = self.drive_service.copy_many([
+            (ss['id'], ss['name'], bu_id) for ss in scoresheets
+        ])
+        for ss, (response, error) in zip(scoresheets, copies):
+            if error is not None:
+                raise error
+            print("Copying",ss['name'])
+
+            # Override all formulas to static values
+            for data in self.ss_service.generate_all_values(ss['id']):
+                self.ss_service.update_values(
+                    file_id = response.get("id"),
+                    range = data['range'],
+                    values = data['values']
+                )
 
         print("Downloading and cleaning")
-        for file in self.drive_service.get_all_children(bu_id):
+        files = self.drive_service.get_all_children(bu_id)
+        for file in files:
             self.drive_service.download_sheet_as_excel(
                 file_id = file['id'],
                 destination_file_path = os.path.join(_fp,file['name']+".xlsx")
             )
-            self.drive_service.move_to_trash(file['id'])
+        for error in self.drive_service.trash_files(files):
+            if error is not None:
+                raise error
 
         self.drive_service.move_to_trash(bu_id)
 
         return self
 
-    def generate_scoresheets(self, verbose = True):
+    def generate_scoresheets(self, verbose = True, max_workers = 4, resume = False, sheets_per_minute = 60):
         """Makes a copy of the ss_template for each quiz in the environment
-        """
 
-        # Remove everything from the scoresheets folder which is not the viewer
-        for file in self.drive_service.get_all_children(self.env['scoresheets_id']):
-            if file['id'] != self.env['viewer_id']:
-                self.drive_service.move_to_trash(file['id'])
+        The copies are made concurrently by a pool of worker threads, keeping
+        under the Sheets write limit and retrying rate limit errors with
+        exponential backoff. A failed copy is only tried again if the
+        scoresheet wasn't made after all (see
+        `DriveService.copy_to_with_backoff`). The url of each scoresheet is saved into its quiz
+        of self.env['draw'] (in the draw's order) and to the local `.env` as
+        it is made, so an interrupted run can be picked up with resume = True.
 
-        # Generate all the scoresheets and save their urls into the environment
-        for i in range(len(self.env['draw'])):
-            quiz_num = self.env['draw'][i]['quiz_num']
-            if verbose:
-                print('Generating quiz {}'.format(quiz_num))
+        max_workers : int
+            The number of scoresheets being made at once
 
-            response = self.drive_service.copy_to(
+        resume : boolean
+            If resume, the scoresheets already made (with a url in the draw)
+            are kept, and only the missing ones are made. Otherwise every
+            scoresheet is made from scratch
+
+        sheets_per_minute : int
+            The most Sheets API writes to make each minute
+        """
+
+        # Remove everything from the scoresheets folder which is not the viewer,
+        #  or (if resuming) a finished scoresheet
+        done = set()
+        if resume:
+            for quiz in self.env['draw']:
+                if quiz.get('url'):
+                    done.add(urlparse(quiz['url']).path.split("/")[-2])
+        for error in self.drive_service.trash_files([
+            file for file in self.drive_service.get_all_children(self.env['scoresheets_id'])
+            if file['id'] != self.env['viewer_id'] and not file['id'] in done
+        ]):
+            if error is not None:
+                raise error
+
+        todo = []
+        for i, quiz in enumerate(self.env['draw']):
+            if resume and quiz.get('url') and urlparse(quiz['url']).path.split("/")[-2] in done:
+                continue
+            quiz['url'] = ""
+            todo.append(i)
+        if verbose and resume:
+            print("Resuming, {} of {} scoresheets left".format(len(todo), len(self.env['draw'])))
+
+        # A drive and sheets client for each worker thread
+        local = threading.local()
+        limiter = RateLimiter(sheets_per_minute)
+        def make_scoresheet(quiz_num):
+            if not hasattr(local, 'drive_service'):
+                local.drive_service = DriveService(build('drive', 'v3', credentials=self.creds))
+                local.ss_service = ScoresheetService(build('sheets', 'v4', credentials=self.creds))
+            response = local.drive_service.copy_to_with_backoff(
                 file_id = self.env['ss_template_id'],
                 name = quiz_num,
                 destination_folder_id = self.env['scoresheets_id'],
                 fields = "id, webViewLink"
             )
-
-            self.ss_service.set_quiz_number_for(
+            with_backoff(
+                local.ss_service.set_quiz_number_for,
                 file_id = response.get('id'),
-                quiz_num = quiz_num
+                quiz_num = quiz_num,
+                limiter = limiter
             )
+            return response.get('webViewLink')
 
-            self.env['draw'][i]['url'] = response.get('webViewLink')
-
+        # Generate all the scoresheets and save their urls into the environment
+        executor = ThreadPoolExecutor(max_workers = max_workers)
+        futures = {
+            executor.submit(make_scoresheet, self.env['draw'][i]['quiz_num']): i
+            for i in todo
+        }
+        try:
+            for n, future in enumerate(as_completed(futures)):
+                i = futures[future]
+                self.env['draw'][i]['url'] = future.result()
+                self.save_env()
+                if verbose:
+                    print('Generated quiz {} ({}/{})'.format(self.env['draw'][i]['quiz_num'], n+1, len(todo)))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            if verbose:
+                print("Interrupted, call .generate_scoresheets(resume = True) to continue")
+            raise
+        finally:
+            executor.shutdown(wait = True)
+            # The workers' copies bypass the folder listing cache
+            self.drive_service.invalidate([self.env['scoresheets_id']])
+            self.save_env()
 
         # Add urls into stats document
         self.stats_service.update_ss_urls(self.env['draw'])
@@ -1,3 +1,9 @@
+import threading
+from time import sleep, monotonic
+
+from apiclient.errors import HttpError
+
+
 class IDError(Exception):
     pass
 
@@ -17,3 +23,48 @@ class Service:
 
     def __repr__(self):
         return "<Base Service Object>"
+
+
+class RateLimiter:
+    """Spaces out calls to at most `per_minute` a minute, across threads
+
+    Google limits the requests of each user, e.g. 60 Sheets writes a minute,
+    so call `.wait()` before each request.
+    """
+    def __init__(self, per_minute):
+        self.interval = 60.0/per_minute
+        self.__next = monotonic()
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        with self.__lock:
+            now = monotonic()
+            t = max(now, self.__next)
+            self.__next = t + self.interval
+        if t > now:
+            sleep(t - now)
+
+
+def is_retryable(error):
+    # Rate limits (403 or 429 with a rate limit reason) and server errors
+    status = error.resp.status
+    if status == 403:
+        return b"ateLimitExceeded" in (error.content or b"")
+    return status == 429 or status >= 500
+
+
+def with_backoff(function, *args, limiter = None, retries = 5, delay = 1.0, **kwargs):
+    """Call `function(*args, **kwargs)`, retrying rate limit and server errors
+
+    The wait between tries doubles each time, starting from `delay` seconds.
+    If `limiter` (a `RateLimiter`) is given, every try waits on it first.
+    """
+    for attempt in range(retries+1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return function(*args, **kwargs)
+        except HttpError as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+        sleep(delay*2**attempt)
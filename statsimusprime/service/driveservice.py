@@ -1,13 +1,51 @@
 
 from apiclient.http import MediaFileUpload, MediaIoBaseDownload
 
-from .baseservice import IDError, Service
+import os
+import json
+import socket
+import threading
+from time import sleep, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from apiclient.errors import HttpError
+
+from .baseservice import IDError, Service, is_retryable, with_backoff
+
+# The most requests the Drive API takes in one batch HTTP request
+BATCH_LIMIT = 100
+
+
+FOLDER = 'application/vnd.google-apps.folder'
 
 
 class DriveService(Service):
-    def __init__(self, google_service_object, id = None, trash_id = None):
+    def __init__(self, google_service_object, id = None, trash_id = None, client_factory = None,
+                 cache_ttl = 0, cache_size = 256, cache_path = None):
         Service.__init__(self, google_service_object, id)
         self.trash_id = trash_id
+        # Makes a new drive client for each worker thread (the google clients
+        #  aren't thread safe), without one the workers run one at a time
+        self.client_factory = client_factory
+        self.__local = threading.local()
+
+        # The folder listings of .get_all_children(...), by folder id, as
+        #  (time listed, children) with the most recently used last. Entries
+        #  expire after `cache_ttl` seconds (0 turns the cache off), only
+        #  `cache_size` are kept, and they're saved to `cache_path` if given
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.__cache = OrderedDict()
+        self.__cache_lock = threading.RLock()
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    self.__cache.update((k, tuple(v)) for k, v in json.load(f).items())
+            except (ValueError, TypeError):
+                # A corrupt cache is just a cold one
+                self.__cache.clear()
 
     def __repr__(self):
         return "<DriveService Object>"
@@ -21,7 +59,19 @@ class DriveService(Service):
     def trash_id(self,id):
         self.__trash_id = id
 
-    def get_all_children(self,folder_id):
+    def get_all_children(self, folder_id, use_cache = True):
+        """List the files in a folder, as {name, id, mimeType, parents}
+
+        The listing comes from the cache if it was listed in the last
+        `cache_ttl` seconds, unless `use_cache` is False.
+        """
+        if use_cache and self.cache_ttl > 0:
+            with self.__cache_lock:
+                entry = self.__cache.get(folder_id)
+                if entry is not None and time() - entry[0] < self.cache_ttl:
+                    self.__cache.move_to_end(folder_id)
+                    return [dict(file) for file in entry[1]]
+
         # adapted from https://developers.google.com/drive/api/v3/search-files
         page_token = None
         children = []
@@ -42,50 +92,218 @@ class DriveService(Service):
             page_token = response.get('nextPageToken', None)
             if page_token is None:
                 break
+
+        if self.cache_ttl > 0:
+            with self.__cache_lock:
+                self.__cache[folder_id] = (time(), [dict(file) for file in children])
+                self.__cache.move_to_end(folder_id)
+                while len(self.__cache) > self.cache_size:
+                    self.__cache.popitem(last = False)
+                self.save_cache()
         return children
 
-    def move_to_trash(self,file_id):
-        # Get file's current parents
-        file = self.service.files().get(
-            fileId=file_id,
-            fields='name, parents'
-        ).execute()
+    def invalidate(self, folder_ids = (), file_ids = ()):
+        """Drop cached listings of `folder_ids`, and of any folder which
+        lists (or is) one of `file_ids`
+        """
+        folder_ids, file_ids = set(f for f in folder_ids if f), set(file_ids)
+        if not self.__cache or not (folder_ids or file_ids):
+            return self
+        with self.__cache_lock:
+            for key, (_, children) in list(self.__cache.items()):
+                if key in folder_ids or key in file_ids or any(file['id'] in file_ids for file in children):
+                    del self.__cache[key]
+            self.save_cache()
+        return self
+
+    def clear_cache(self):
+        with self.__cache_lock:
+            self.__cache.clear()
+            self.save_cache()
+        return self
+
+    def save_cache(self):
+        # Write the cache to `cache_path`, replacing the old one in one go
+        if self.cache_path is None:
+            return self
+        with self.__cache_lock:
+            with open(self.cache_path+".tmp", "w") as f:
+                json.dump(self.__cache, f)
+            os.replace(self.cache_path+".tmp", self.cache_path)
+        return self
+
+    def execute_batch(self, requests, retries = 5, delay = 1.0):
+        """Execute many requests in as few batch HTTP requests as possible
+
+        Requests are sent in multipart batches of up to BATCH_LIMIT. Items
+        which fail with a rate limit or server error are retried in a later
+        batch, waiting `delay` seconds (doubling each time) in between.
+
+        Parameters
+        ----------
+        requests : list
+            Unexecuted requests, e.g. self.service.files().delete(fileId = id)
+
+        returns : list of (response, error)
+            For each request, in order, its response (None if it failed) and
+            the HttpError it failed with (None if it didn't)
+        """
+        results = [(None, None)]*len(requests)
+        todo = list(range(len(requests)))
+        for attempt in range(retries+1):
+            failed = []
+            def callback(request_id, response, exception):
+                i = int(request_id)
+                results[i] = (response, exception)
+                if exception is not None and attempt < retries and is_retryable(exception):
+                    failed.append(i)
+            for n in range(0, len(todo), BATCH_LIMIT):
+                batch = self.service.new_batch_http_request(callback = callback)
+                for i in todo[n:n+BATCH_LIMIT]:
+                    batch.add(requests[i], request_id = str(i))
+                batch.execute()
+            if not failed:
+                break
+            todo = sorted(failed)
+            sleep(delay*2**attempt)
+        return results
+
+    def move_to_trash(self, file_id, name = None, parents = None):
+        """Move a file to the trash folder
+
+        If the name and parents of the file are given (e.g. from
+        .get_all_children(...)), they aren't fetched first.
+        """
+        if name is None or parents is None:
+            # Get file's current parents
+            file = self.service.files().get(
+                fileId=file_id,
+                fields='name, parents'
+            ).execute()
+            name, parents = file.get('name'), file.get('parents')
         # Remove old parents and attach new parent "trash"
-        previous_parents = ",".join(file.get('parents'))
-        file = self.service.files().update(
-            fileId=file_id,
-            addParents=self.trash_id,
-            removeParents=previous_parents,
-            body = {'name':'_'+file.get('name')},
-            fields='id, parents'
-        ).execute()
+        self._trash_request({'id': file_id, 'name': name, 'parents': parents}).execute()
+        self.invalidate(list(parents)+[self.trash_id], [file_id])
 
         return self
 
+    def _trash_request(self, file):
+        # Move `file` (with its id, name and parents) into the trash folder
+        return self.service.files().update(
+            fileId = file['id'],
+            addParents = self.trash_id,
+            removeParents = ",".join(file['parents']),
+            body = {'name':'_'+file['name']},
+            fields = 'id, parents'
+        )
+
+    def trash_files(self, files):
+        """Move many files to the trash folder with batch requests
+
+        Uses the name and parents already in `files` (e.g. as returned by
+        .get_all_children(...)), so this is one request per file, batched.
+
+        files : list of {id, name, parents}
+
+        returns : list of HttpError or None, for each file
+        """
+        errors = [error for _, error in self.execute_batch([self._trash_request(file) for file in files])]
+        self.invalidate(
+            [p for file in files for p in file['parents']]+[self.trash_id],
+            [file['id'] for file in files]
+        )
+        return errors
+
     def delete_file(self,id):
         self.service.files().delete(fileId = id).execute()
+        self.invalidate(file_ids = [id])
 
         return self
 
-    def delete_recursive(self, id, verbose = True):
-        file = self.service.files().get(fileId = id).execute()
-        self.__delete_recusive(file, verbose)
+    def delete_files(self, file_ids):
+        """Delete many files with batch requests
+
+        returns : list of HttpError or None, for each file
+        """
+        errors = [error for _, error in self.execute_batch([
+            self.service.files().delete(fileId = id) for id in file_ids
+        ])]
+        self.invalidate(file_ids = file_ids)
+        return errors
+
+    def _thread_service(self):
+        # A DriveService with a client of its own for the current thread
+        if self.client_factory is None:
+            return self
+        if not hasattr(self.__local, 'service'):
+            self.__local.service = DriveService(self.client_factory())
+        return self.__local.service
+
+    def delete_recursive(self, id, verbose = True, max_workers = 8):
+        """Delete a file, or a folder and everything in it
+
+        See .delete_tree(...)
+        """
+        file = with_backoff(self.service.files().get(fileId = id, fields = 'id, name, mimeType').execute)
+        self.delete_tree([file], verbose, max_workers)
 
         return self
 
-    def __delete_recusive(self, file, verbose = True):
-        if file['mimeType'] == 'application/vnd.google-apps.folder':
-            for _file in self.get_all_children(file['id']):
-                self.__delete_recusive(_file)
-        if verbose:
-            print("Deleting: ",file['name'])
-        self.delete_file(file['id'])
+    def delete_tree(self, files, verbose = True, max_workers = 8):
+        """Delete files, and everything inside the folders among them
+
+        The folders are listed in parallel, one level at a time, by a pool of
+        `max_workers` threads (only one, unless the service has a
+        `client_factory`). Then everything is deleted deepest first, in
+        batches of up to BATCH_LIMIT which also run in parallel. Failed
+        listings and deletes are retried with backoff, and files which are
+        already gone are skipped.
 
-        return
+        files : list of {id, name, mimeType}
 
-    def empty_trash(self):
-        for file in self.get_all_children(self.trash_id):
-            self.delete_file(file['id'])
+        returns : int, the number of files deleted
+        """
+        if self.client_factory is None:
+            max_workers = 1
+        levels = [list(files)]
+        try:
+            with ThreadPoolExecutor(max_workers = max_workers) as pool:
+                # Walk down the tree
+                while True:
+                    folders = [file['id'] for file in levels[-1] if file.get('mimeType') == FOLDER]
+                    if not folders:
+                        break
+                    children = pool.map(lambda id: with_backoff(self._thread_service().get_all_children, id), folders)
+                    levels.append([file for files in children for file in files])
+                    if verbose:
+                        print("Found {} files".format(sum(len(level) for level in levels)))
+
+                # Delete from the bottom up, so the folders are empty when deleted
+                total, deleted = sum(len(level) for level in levels), 0
+                def delete(ids):
+                    return self._thread_service().delete_files(ids)
+                for level in reversed(levels):
+                    ids = [file['id'] for file in level]
+                    chunks = [ids[n:n+BATCH_LIMIT] for n in range(0, len(ids), BATCH_LIMIT)]
+                    for chunk, errors in zip(chunks, pool.map(delete, chunks)):
+                        for error in errors:
+                            # Already gone (e.g. deleted with its folder) is fine
+                            if error is not None and error.resp.status != 404:
+                                raise error
+                        deleted += len(chunk)
+                        if verbose:
+                            print("Deleted {}/{}".format(deleted, total))
+        finally:
+            # Some of the files may be gone even if a later delete failed
+            self.invalidate(file_ids = [file['id'] for level in levels for file in level])
+        return total
+
+    def empty_trash(self, verbose = False, max_workers = 8):
+        """Delete everything in the trash folder, see .delete_tree(...)
+        """
+        self.delete_tree(self.get_all_children(self.trash_id), verbose, max_workers)
+
+        return self
 
     def create_folder(self,name,parent_folder_id=None):
         pfid = parent_folder_id or ""
@@ -94,10 +312,12 @@ class DriveService(Service):
             'mimeType': 'application/vnd.google-apps.folder',
             'parents': [pfid]
         }
-        return self.service.files().create(
+        file = self.service.files().create(
             body = file_metadata,
             fields = 'id'
         ).execute()
+        self.invalidate([pfid])
+        return file
 
     def upload_excel_as_sheet(self,name,file_path,parent_folder_id=None):
         pfid = parent_folder_id or ""
@@ -111,11 +331,13 @@ class DriveService(Service):
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             resumable=True
         )
-        return self.service.files().create(
+        file = self.service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id'
         ).execute()
+        self.invalidate([pfid])
+        return file
 
     def download_sheet_as_excel(self, file_id, destination_file_path, verbose = False):
         request = self.service.files().export_media(
@@ -150,11 +372,13 @@ class DriveService(Service):
             resumable=True
         )
 
-        return self.service.files().create(
+        file = self.service.files().create(
             body=file_metadata,
             media_body=media,
             fields = "id"
         ).execute()
+        self.invalidate([pfid])
+        return file
 
 
     def update_json(self, file_id, file_path):
@@ -195,7 +419,7 @@ class DriveService(Service):
 
 
     def copy_to(self, file_id, name, destination_folder_id, fields = "id"):
-        return self.service.files().copy(
+        file = self.service.files().copy(
             fileId = file_id,
             fields = fields,
             body = {
@@ -203,7 +427,68 @@ class DriveService(Service):
                 'parents': [destination_folder_id]
             }
         ).execute()
+        self.invalidate([destination_folder_id])
+        return file
+
+    def find_file(self, name, folder_id, fields = "id"):
+        """The first file called `name` in a folder, or None
 
+        This always asks Drive, rather than the folder listing cache.
+        """
+        files = self.service.files().list(
+            q = "name = '{}' and '{}' in parents and trashed = false".format(
+                name.replace("\\", "\\\\").replace("'", "\\'"), folder_id
+            ),
+            spaces = 'drive',
+            fields = 'files({})'.format(fields)
+        ).execute().get('files', [])
+        return files[0] if files else None
+
+    def copy_to_with_backoff(self, file_id, name, destination_folder_id, fields = "id", retries = 5, delay = 1.0):
+        """Copy a file, see .copy_to(...), retrying rate limit and server
+        errors and timeouts with backoff (see with_backoff(...))
+
+        A copy isn't idempotent, a try which failed with a server error or
+        timed out may still have made the copy. So before trying again, this
+        looks for a file called `name` in the destination folder, and returns
+        it if there is one.
+        """
+        for attempt in range(retries+1):
+            if attempt > 0:
+                file = with_backoff(self.find_file, name, destination_folder_id, fields)
+                if file is not None:
+                    self.invalidate([destination_folder_id])
+                    return file
+            try:
+                return self.copy_to(file_id, name, destination_folder_id, fields)
+            except HttpError as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+            except socket.timeout:
+                if attempt == retries:
+                    raise
+            sleep(delay*2**attempt)
+
+    def copy_many(self, copies, fields = "id"):
+        """Copy many files with batch requests
+
+        copies : list of (file_id, name, destination_folder_id)
+
+        returns : list of (response, error), for each copy
+        """
+        results = self.execute_batch([
+            self.service.files().copy(
+                fileId = file_id,
+                fields = fields,
+                body = {
+                    'name': name,
+                    'parents': [destination_folder_id]
+                }
+            )
+            for file_id, name, destination_folder_id in copies
+        ])
+        self.invalidate([destination_folder_id for _, _, destination_folder_id in copies])
+        return results
 
     def get_file_url(self, file_id):
         return self.service.files().get(
@@ -0,0 +1,109 @@
+# Benchmark the speed and quality of the prelim draw generation
+#
+# Usage:
+#   python test-tools/benchmark_draw.py [output_stem] [steps] [repeats]
+#
+#   output_stem : where to write the results, `bench` -> bench.csv, bench.json
+#   steps : comma separated annealing step counts, e.g. 1000,10000
+#   repeats : number of seeds to run for each meet size and step count
+
+import os
+import csv
+import json
+from sys import argv, path
+from time import perf_counter
+
+path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from statsimusprime.draw import Prelims
+
+# (nTeams, QpT, nRooms) for each meet size in the sweep
+MEETS = [
+    ( 9, 6, 3),
+    (12, 6, 4),
+    (18, 6, 4),
+    (24, 6, 6),
+    (30, 6, 8),
+    (36, 6, 8),
+    (45, 6, 10),
+    (60, 6, 12),
+]
+
+try:
+    fp_stem = argv[1]
+except IndexError:
+    fp_stem = "bench"
+
+try:
+    steps_list = [int(s) for s in argv[2].split(",")]
+except IndexError:
+    steps_list = [10**3, 10**4]
+
+try:
+    repeats = int(argv[3])
+except IndexError:
+    repeats = 3
+
+results = []
+for nTeams, QpT, nRooms in MEETS:
+    for steps in steps_list:
+        for seed in range(repeats):
+            prelim = Prelims(nTeams, QpT, nRooms, 0.5, seed = seed)
+
+            t0 = perf_counter()
+            prelim.initialize()
+            t1 = perf_counter()
+            E_initial = prelim.E
+            prelim.anneal(steps)
+            t2 = perf_counter()
+            prelim.get_stats()
+            t3 = perf_counter()
+
+            metrics = prelim.get_metrics()
+            result = {
+                "teams": nTeams,
+                "QpT": QpT,
+                "rooms": nRooms,
+                "steps": steps,
+                "seed": seed,
+                "initialize_s": t1-t0,
+                "anneal_s": t2-t1,
+                "get_stats_s": t3-t2,
+                "us_per_step": 1e6*(t2-t1)/steps,
+                "E_initial": E_initial,
+                "E_final": prelim.E,
+                "conflicts": sum(metrics['conflicts']),
+                "back_to_back": sum(metrics['back_to_back']),
+                "hat_tricks": sum(metrics['hat_tricks'])
+            }
+            results.append(result)
+            print("T={teams: >2} R={rooms: >2} N={steps: >7} seed={seed} : {anneal_s:.2f}s : E={E_final:.2f}".format(**result))
+
+with open(fp_stem+".csv", "w+", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames = list(results[0].keys()))
+    writer.writeheader()
+    writer.writerows(results)
+
+with open(fp_stem+".json", "w+") as f:
+    f.write(json.dumps(results, indent=4))
+
+# Summarize each meet size and step count, averaged over the seeds
+print()
+print("{: >5} {: >5} {: >8} {: >8} {: >8} {: >8} {: >8} {: >5} {: >5} {: >5}".format(
+    "teams", "rooms", "steps", "init(s)", "anneal(s)", "us/step", "E", "CQ", "BTB", "HT"
+))
+for nTeams, QpT, nRooms in MEETS:
+    for steps in steps_list:
+        rr = [r for r in results if r['teams'] == nTeams and r['steps'] == steps]
+        mean = lambda key: sum(r[key] for r in rr) / len(rr)
+        print("{: >5} {: >5} {: >8} {: >8.3f} {: >9.3f} {: >8.1f} {: >8.2f} {: >5.1f} {: >5.1f} {: >5.1f}".format(
+            nTeams,
+            nRooms,
+            steps,
+            mean("initialize_s"),
+            mean("anneal_s"),
+            mean("us_per_step"),
+            mean("E_final"),
+            mean("conflicts"),
+            mean("back_to_back"),
+            mean("hat_tricks")
+        ))
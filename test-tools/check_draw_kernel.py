@@ -0,0 +1,166 @@
+# Check that the annealing kernel (statsimusprime/draw_kernel.py) matches the
+#  pure Python `Prelims` annealer
+#
+# Usage:
+#   python test-tools/check_draw_kernel.py [steps] [repeats]
+#
+#   steps : number of annealing steps for each draw
+#   repeats : number of seeds to run for each meet size
+#
+# For fixed seeds this checks that:
+#   - the kernel counts exactly the same events for each team as `Prelims`
+#     does, on scrambled draws with conflicts and crossed divisions
+#   - the kernel keeps the energy, team indices and pair counts of the draw in
+#     step with a recount from scratch
+#   - the compiled kernel gives exactly the same draw as the kernel run as
+#     plain Python (only if numba is installed)
+#   - a kernel run resumed from a checkpoint matches an uninterrupted one
+# and compares the final energies and speed of both backends.
+
+import os
+import signal
+import subprocess
+from random import Random
+from sys import argv, path, executable
+from time import perf_counter
+
+path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from statsimusprime import draw_kernel
+from statsimusprime.draw import Prelims
+
+# (nTeams, QpT, nRooms, divisions, division_rooms) for each meet size
+MEETS = [
+    ( 9, 6, 3, None, None),
+    (18, 6, 4, None, None),
+    (30, 6, 8, None, None),
+    (45, 6, 10, None, None),
+    (21, 6, 5, [0]*12 + [1]*9, [[0, 1, 2, 3], [3, 4]]),
+]
+
+try:
+    steps = int(argv[1])
+except IndexError:
+    steps = 5000
+
+try:
+    repeats = int(argv[2])
+except IndexError:
+    repeats = 3
+
+# Run as a child process with the JIT turned off, just print the draws
+plain = "--plain" in argv
+
+
+def make(nTeams, QpT, nRooms, divisions, division_rooms, seed):
+    return Prelims(nTeams, QpT, nRooms, 0.5, seed = seed, divisions = divisions, division_rooms = division_rooms).initialize()
+
+
+def check_state(prelim):
+    # Recount everything the kernel keeps track of from the seats
+    fresh = Prelims(prelim.T, prelim.qpt, prelim.R, None, prelim.B, divisions = prelim.divisions)
+    fresh.breakindex, fresh.room_ok, fresh.multidivision = prelim.breakindex, prelim.room_ok, prelim.multidivision
+    for si in range(prelim.S):
+        for ri in range(prelim.R):
+            for t in prelim.teams_in(si, ri):
+                fresh.push(t, si, ri)
+    assert abs(prelim.E - fresh.get_total_energy()) < 1e-6, "energy is out of step"
+    assert [sorted(p) for p in prelim.Tquiz] == [sorted(p) for p in fresh.Tquiz], "team index is out of step"
+    assert [{k:v for k,v in p.items() if v} for p in prelim.pairs] == [{k:v for k,v in p.items() if v} for p in fresh.pairs], "pair counts are out of step"
+    assert prelim.occupancy == fresh.occupancy, "occupancy is out of step"
+
+
+def check_events(prelim, rng):
+    # Compare the event counts of the kernel and `Prelims`, for every team and
+    #  for random groups of teams like those of an interchange
+    state = prelim._kernel_state({})
+    (seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, hot, hot_index, teams, hot_flags, _, _, _, _,
+        T, R, S, QpT, nQuizzes, breakindex, multidivision) = state
+    for t in range(T):
+        kernel_events = list(draw_kernel._team_events(
+            seats, counts, occupancy, pairs, tq, divisions, room_ok, T, R, S, QpT, breakindex, multidivision, t
+        ))
+        assert kernel_events == prelim.get_team_events(t)[:6], "events of team {} don't match".format(t)
+    for _ in range(20):
+        group = rng.sample(range(T), rng.randint(1, min(6, T)))
+        for i, t in enumerate(group):
+            teams[i] = t
+        E = draw_kernel._local_energy(
+            seats, counts, occupancy, pairs, tq, divisions, room_ok, weights, T, R, S, QpT, breakindex, multidivision,
+            teams, len(group), hot_flags
+        )
+        events = prelim.get_local_events(group)
+        assert abs(E - sum(w*n for w, n in zip(prelim.energy_weights, events))) < 1e-6, "local energies don't match"
+
+
+if plain:
+    for meet in MEETS:
+        for seed in range(repeats):
+            print(make(*meet, seed).anneal(steps, backend = "kernel").to_text().replace("\n", "/"))
+    exit()
+
+print("numba installed:", draw_kernel.HAVE_NUMBA)
+
+# The kernel and `Prelims` score every draw the same way. Hot thermalization
+#  scrambles the draws, so that they have conflicts and hat tricks to count
+rng = Random(0)
+for meet in MEETS:
+    for seed in range(repeats):
+        prelim = make(*meet, seed).thermalize(200, kT = 20.0)
+        check_events(prelim, rng)
+        check_events(prelim.anneal(steps//10), rng)
+print("Kernel events match Prelims: OK")
+
+texts = []
+print("{: >5} {: >5} {: >10} {: >10} {: >10} {: >10}".format("teams", "rooms", "python(s)", "kernel(s)", "python E", "kernel E"))
+for meet in MEETS:
+    times, energies = {"python": 0.0, "kernel": 0.0}, {"python": 0.0, "kernel": 0.0}
+    for seed in range(repeats):
+        for backend in ("python", "kernel"):
+            prelim = make(*meet, seed)
+            t0 = perf_counter()
+            prelim.anneal(steps, backend = backend)
+            times[backend] += perf_counter() - t0
+            energies[backend] += prelim.E
+            check_state(prelim)
+            if backend == "kernel":
+                texts.append(prelim.to_text().replace("\n", "/"))
+    print("{: >5} {: >5} {: >10.3f} {: >10.3f} {: >10.2f} {: >10.2f}".format(
+        meet[0],
+        meet[2],
+        times["python"] / repeats,
+        times["kernel"] / repeats,
+        energies["python"] / repeats,
+        energies["kernel"] / repeats
+    ))
+print("Kernel state matches a recount: OK")
+
+# Resuming from a checkpoint gives the same draw as an uninterrupted run, so
+#  press Ctrl-C (from here) half way through a run
+fp = "check_draw_kernel.ckpt"
+every = max(1, steps//4)
+full = make(*MEETS[2], 0).anneal(steps, backend = "kernel", checkpoint = fp, checkpoint_every = every)
+kernel_run, calls = draw_kernel.run, []
+def interrupt(*args):
+    calls.append(1)
+    if len(calls) == 2:
+        os.kill(os.getpid(), signal.SIGINT)
+    return kernel_run(*args)
+draw_kernel.run = interrupt
+try:
+    make(*MEETS[2], 0).anneal(steps, backend = "kernel", checkpoint = fp, checkpoint_every = every)
+except KeyboardInterrupt:
+    pass
+draw_kernel.run = kernel_run
+resumed = Prelims.resume(fp)
+os.remove(fp)
+assert resumed.to_text() == full.to_text(), "resumed run doesn't match"
+print("Resumed kernel run matches: OK")
+
+if draw_kernel.COMPILED:
+    env = dict(os.environ, NUMBA_DISABLE_JIT = "1")
+    out = subprocess.run(
+        [executable, os.path.abspath(__file__), str(steps), str(repeats), "--plain"],
+        env = env, stdout = subprocess.PIPE, universal_newlines = True, check = True
+    ).stdout.split()
+    assert out == texts, "compiled kernel doesn't match plain Python"
+    print("Compiled kernel matches plain Python: OK")